@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+import argparse
+import configparser
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from genderiser import Genderiser, SubstitutionTable, Template
+
+
+def synthetic_subs(surnames):
+    subs = {}
+    for i, surname in enumerate(surnames):
+        gender = ("male", "female", "they")[i % 3]
+        for word, value in configparser_items(gender):
+            subs["%s_%s" % (surname, word)] = value
+    return subs
+
+
+def synthetic_text(size, density, surnames, words, seed=0):
+    """Roughly size characters of filler text, in which about one word in every density is a variable."""
+    rng = random.Random(seed)
+    filler = "the quick brown fox jumps over a lazy dog and then runs away".split()
+    parts = []
+    length = 0
+
+    while length < size:
+        if rng.randrange(density) == 0:
+            surname = rng.choice(surnames)
+            if rng.randrange(4) == 0:
+                surname = surname.capitalize()
+            part = "%s_%s" % (surname, rng.choice(words))
+        else:
+            part = rng.choice(filler)
+        parts.append(part)
+        length += len(part) + 1
+
+    return " ".join(parts)
+
+
+def callback_sub(regex, subs, text):
+    """The original implementation of replace: a Python callback for every variable."""
+    def var_sub(m):
+        surname, word = m.groups()
+        key = "%s_%s" % (surname.lower(), word.lower())
+        replacement = subs.get(key)
+        if replacement:
+            if surname == surname.capitalize():
+                return replacement.capitalize()
+            return replacement
+        else:
+            return "UNKNOWN"
+
+    return regex.sub(var_sub, text)
+
+
+def best_of(repeat, function, *args):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+ODT_CONTENT = """<?xml version="1.0" encoding="UTF-8"?>
+<office:document-content xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" office:version="1.2"><office:body><office:text>%s</office:text></office:body></office:document-content>"""
+
+ODT_MANIFEST = """<?xml version="1.0" encoding="UTF-8"?>
+<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" manifest:version="1.2"><manifest:file-entry manifest:full-path="/" manifest:media-type="application/vnd.oasis.opendocument.text"/><manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/></manifest:manifest>"""
+
+DOCX_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"><Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/><Default Extension="xml" ContentType="application/xml"/><Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/></Types>"""
+
+DOCX_RELS = """<?xml version="1.0" encoding="UTF-8"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"><Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/></Relationships>"""
+
+DOCX_DOCUMENT = """<?xml version="1.0" encoding="UTF-8"?>
+<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>%s</w:body></w:document>"""
+
+
+def paragraphs(text, words=100):
+    text = text.split(" ")
+    return [" ".join(text[i:i + words]) for i in range(0, len(text), words)]
+
+
+def write_odt(path, text):
+    body = "".join("<text:p>%s</text:p>" % p for p in paragraphs(text))
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr(zipfile.ZipInfo("mimetype"), "application/vnd.oasis.opendocument.text", zipfile.ZIP_STORED)
+        z.writestr("content.xml", ODT_CONTENT % body)
+        z.writestr("META-INF/manifest.xml", ODT_MANIFEST)
+
+
+def write_docx(path, text):
+    body = "".join("<w:p><w:r><w:t>%s</w:t></w:r></w:p>" % p for p in paragraphs(text))
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES)
+        z.writestr("_rels/.rels", DOCX_RELS)
+        z.writestr("word/document.xml", DOCX_DOCUMENT % body)
+
+
+def generate_project(project_dir, characters=20, inheritance=2, files=20, size=20000, density=20, formats="txt,odt,docx", seed=0):
+    """Write a synthetic project: a config with characters and a chain of inherited custom genders, and documents in a mix of formats."""
+    surnames = ["character%s" % chr(ord("a") + i) for i in range(characters)] if characters <= 26 else ["character%d" % i for i in range(characters)]
+
+    # A chain of custom genders, each inheriting from the last, ending in the built-in "they"
+    genders = ["male", "female", "they", "spivak"]
+    config = ["[genders]"]
+    parent = "they"
+    for i in range(inheritance):
+        gender = "custom%d" % i
+        config.append("%s = %s" % (gender, parent))
+        genders.append(gender)
+        parent = gender
+    config.append("")
+
+    config.append("[characters]")
+    for i, surname in enumerate(surnames):
+        config.append("%s = %s" % (surname, genders[i % len(genders)]))
+    config.append("")
+
+    for gender in genders:
+        config.append("[%s]" % gender)
+        if gender.startswith("custom"):
+            config.extend(["they = c%s" % gender, "them = cm%s" % gender])
+        for surname in surnames:
+            config.append("%s_name = %s%s" % (surname, surname.capitalize(), gender))
+        config.append("")
+
+    formats = formats.split(",")
+    filenames = ["document%04d.%s" % (i, formats[i % len(formats)]) for i in range(files)]
+    config.extend(["[files]", "files = %s" % ", ".join(filenames), ""])
+
+    with open(os.path.join(project_dir, "project.cfg"), "w") as f:
+        f.write("\n".join(config))
+
+    words = ["name"] + [word for word, value in configparser_items("they")]
+    for i, filename in enumerate(filenames):
+        text = synthetic_text(size, density, surnames, words, seed + i)
+        path = os.path.join(project_dir, filename)
+        if filename.endswith(".odt"):
+            write_odt(path, text)
+        elif filename.endswith(".docx"):
+            write_docx(path, text)
+        else:
+            with open(path, "w") as f:
+                f.write(text)
+
+
+def configparser_items(section):
+    cp = configparser.ConfigParser()
+    cp.read_file(io.StringIO(Genderiser.BUILTIN_CONFIG))
+    return cp.items(section)
+
+
+def bench_substitution(args):
+    surnames = ["character%s" % chr(ord("a") + i) for i in range(args.characters)]
+    subs = synthetic_subs(surnames)
+    words = sorted(set(key.split("_", 1)[1] for key in subs))
+    text = synthetic_text(args.size, args.density, surnames, words)
+    regex = re.compile(Genderiser.BUILTIN_CONFIG.split("variable_regex = ")[1].split("\n")[0])
+
+    table = SubstitutionTable(subs)
+    template = Template.from_text(regex, text)
+
+    # Both paths must give the same result for lowercase and capitalised variables
+    assert template.render(table) == callback_sub(regex, subs, text)
+
+    callback = best_of(args.repeat, callback_sub, regex, subs, text)
+    tokenize = best_of(args.repeat, Template.from_text, regex, text)
+    render = best_of(args.repeat, template.render, table)
+
+    # Scanning for variables dominates both paths, so the first cast of a document costs about the same either way. Only casts rendered from the same template, or from a cached one, are faster.
+    return {
+        "document_characters": len(text),
+        "document_variables": len(template.slots),
+        "callback_substitution": callback,
+        "tokenize": tokenize,
+        "render": render,
+        "first_cast_time_ratio": (tokenize + render) / callback,
+        "speedup_extra_cast": callback / render,
+    }
+
+
+def bench_project(args):
+    results = {}
+    tempdir = tempfile.mkdtemp()
+
+    try:
+        project_dir = os.path.join(tempdir, "project")
+        output_dir = os.path.join(tempdir, "output")
+        os.mkdir(project_dir)
+
+        start = time.perf_counter()
+        generate_project(project_dir, args.characters, args.inheritance, args.files, args.size, args.density, args.formats)
+        results["generate"] = time.perf_counter() - start
+
+        cache = args.cache
+
+        def construct():
+            return Genderiser(project_dir, cache=cache)
+
+        def find_files():
+            gen = construct()
+            gen.find_files()
+            for filehelper in gen.files:
+                filehelper.close()
+
+        def replace():
+            construct().replace(output_dir, force=True, jobs=args.jobs)
+
+        def missing():
+            with contextlib.redirect_stdout(io.StringIO()):
+                construct().missing()
+
+        def preview():
+            with contextlib.redirect_stdout(io.StringIO()):
+                construct().replace(preview=True, jobs=args.jobs)
+
+        results["construct"] = best_of(args.repeat, construct)
+        # The remaining stages include construction, as they would in a real run
+        results["find_files"] = best_of(args.repeat, find_files)
+        results["replace"] = best_of(args.repeat, replace)
+        results["missing"] = best_of(args.repeat, missing)
+        results["preview"] = best_of(args.repeat, preview)
+        results["input_bytes"] = sum(os.path.getsize(os.path.join(project_dir, f)) for f in os.listdir(project_dir))
+
+    finally:
+        shutil.rmtree(tempdir)
+
+    return results
+
+
+def bench_startup(args):
+    """Time new processes running short commands on a synthetic project, as scripts calling genderiser in a loop would."""
+    results = {}
+    tempdir = tempfile.mkdtemp()
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(here, "genderiser.py")
+
+    def run(*command):
+        subprocess.run([sys.executable] + list(command), cwd=here, stdout=subprocess.DEVNULL, check=True)
+
+    try:
+        project_dir = os.path.join(tempdir, "project")
+        output_dir = os.path.join(tempdir, "output")
+        os.mkdir(project_dir)
+        generate_project(project_dir, args.characters, args.inheritance, args.files, args.size, args.density, args.formats)
+
+        results["python"] = best_of(args.repeat, run, "-c", "pass")
+        results["import"] = best_of(args.repeat, run, "-c", "import genderiser")
+        results["substitutions"] = best_of(args.repeat, run, script, "-s", project_dir)
+        results["render_unchanged"] = best_of(args.repeat, run, script, "-o", output_dir, project_dir)
+        # Reading the config, within a process
+        results["construct"] = best_of(args.repeat, Genderiser, project_dir)
+
+    finally:
+        shutil.rmtree(tempdir)
+
+    return results
+
+
+BENCHMARKS = {
+    "substitution": bench_substitution,
+    "project": bench_project,
+    "startup": bench_startup,
+}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark genderiser on large synthetic documents and projects")
+
+    parser.add_argument("benchmark", help="Which benchmark to run. 'substitution' compares rendering a large document from a template with a regex callback: the first cast takes about as long, and only extra casts are faster. 'project' times each stage of processing a synthetic project. 'startup' times short commands run in new processes.", choices=sorted(BENCHMARKS), nargs="?", default="substitution")
+    parser.add_argument("--size", help="Size of each synthetic document in characters.", type=int)
+    parser.add_argument("--density", help="On average one word in this many is a variable.", type=int, default=20)
+    parser.add_argument("--characters", help="Number of characters.", type=int, default=20)
+    parser.add_argument("--inheritance", help="Length of the chain of inherited custom genders in a synthetic project.", type=int, default=2)
+    parser.add_argument("--files", help="Number of documents in a synthetic project.", type=int, default=30)
+    parser.add_argument("--formats", help="Comma-separated list of document formats in a synthetic project, used in turn.", default="txt,odt,docx")
+    parser.add_argument("--jobs", help="Number of files to process in parallel in a synthetic project.", type=int, default=1)
+    parser.add_argument("--cache", help="Use the template cache in a synthetic project.", action="store_true")
+    parser.add_argument("--repeat", help="Number of times to repeat each measurement. The best time is reported.", type=int, default=3)
+    parser.add_argument("--json", help="Write the parameters and results as JSON to this file, or - for standard output.")
+
+    args = parser.parse_args(args)
+
+    if args.size is None:
+        args.size = {"substitution": 10 * 1024 * 1024, "startup": 2000}.get(args.benchmark, 50000)
+
+    results = BENCHMARKS[args.benchmark](args)
+
+    if args.json:
+        output = {
+            "benchmark": args.benchmark,
+            "parameters": dict((k, v) for (k, v) in vars(args).items() if k not in ("benchmark", "json")),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+        }
+        if args.json == "-":
+            json.dump(output, sys.stdout, indent=1, sort_keys=True)
+            print("")
+        else:
+            with open(args.json, "w") as f:
+                json.dump(output, f, indent=1, sort_keys=True)
+    else:
+        for name, value in results.items():
+            if isinstance(value, float):
+                print("%-30s %12.4f" % (name, value))
+            else:
+                print("%-30s %12d" % (name, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,947 @@
 #!/usr/bin/env python3
 
+# Modules which are slow to import and only needed by some commands (zipfile, hashlib, concurrent.futures, http.server and others) are imported where they are used, so that short runs start quickly
 import re
-import zipfile
 import os
 import glob
 import sys
 import configparser
 import io
-import argparse
-import tempfile
-import shutil
 import string
+import itertools
+import json
+import contextlib
+import time
+import collections
+import bisect
+import fnmatch
 
 class GenderiserError(Exception):
     pass
 
 
+class SubstitutionTable(object):
+    """Substitutions with the lowercase, capitalised and uppercase forms of every value worked out in advance. The case of a replacement follows the case of the character identifier in the variable."""
+    LOWER, CAPITALIZED, UPPER = range(3)
+    UNKNOWN = ("UNKNOWN",) * 3
+
+    def __init__(self, subs):
+        self.subs = subs
+        self.variants = {}
+
+        for key, value in subs.items():
+            # Empty values are treated as missing
+            if value:
+                self.variants[key] = (value, value.capitalize(), value.upper())
+
+    @classmethod
+    def key(cls, surname, word):
+        if surname == surname.capitalize():
+            case = cls.CAPITALIZED
+        elif surname.isupper():
+            case = cls.UPPER
+        else:
+            case = cls.LOWER
+        return "%s_%s" % (surname.lower(), word.lower()), case
+
+    def lookup(self, surname, word):
+        key, case = self.key(surname, word)
+        return self.variants.get(key, self.UNKNOWN)[case]
+
+
+class Template(object):
+    """A document split into literal text and variable slots, so that it can be rendered for many casts without being scanned again."""
+
+    def __init__(self, literals, slots, lengths):
+        # There is always one more literal than there are slots
+        self.literals = literals
+        self.slots = slots
+        # The length of each variable as it was written, so that variables can be located in the original text
+        self.lengths = lengths
+        # Lookup keys are worked out once for each distinct variable, rather than every time the template is rendered
+        keys = dict((slot, SubstitutionTable.key(*slot)) for slot in set(slots))
+        self.keys = [keys[slot] for slot in slots]
+        # How often each distinct variable is used, and the distinct lookup keys, worked out the first time they are needed
+        self.slot_counts = None
+        self.distinct_keys = None
+
+    @classmethod
+    def from_text(cls, regex, text):
+        # Splitting on the regex, wrapped in one more group, gives each literal followed by the whole variable and its groups
+        parts = re.compile("(%s)" % regex.pattern, regex.flags).split(text)
+        stride = regex.groups + 2
+        return cls(parts[::stride], list(zip(parts[2::stride], parts[3::stride])), [len(v) for v in parts[1::stride]])
+
+    def dumps(self):
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def from_xml(cls, regex, xml, break_tag, hidden=None):
+        """Like from_text, but variables are only looked for in the text between tags, and may be split across several tags. See xml_tokens."""
+        literals = []
+        slots = []
+        lengths = []
+        literal = []
+
+        # The whole of the XML is already in memory, so it is split in one go
+        for item in xml_tokens(regex, [xml], break_tag, margin=len(xml), hidden=hidden):
+            if isinstance(item, str):
+                literal.append(item)
+            else:
+                m, length, locate = item
+                literals.append("".join(literal))
+                literal = []
+                slots.append((m.group(1), m.group(2)))
+                lengths.append(length)
+
+        literals.append("".join(literal))
+        return cls(literals, slots, lengths)
+
+    @classmethod
+    def loads(cls, data):
+        return cls.from_dict(json.loads(data))
+
+    @classmethod
+    def from_dict(cls, template):
+        if "parts" in template:
+            return PartsTemplate([(name, cls.from_dict(part)) for name, part in template["parts"]])
+        return cls(template["literals"], [tuple(slot) for slot in template["slots"]], template["lengths"])
+
+    def to_dict(self):
+        return {"literals": self.literals, "slots": self.slots, "lengths": self.lengths}
+
+    def occurrences(self, part=None):
+        """The part, offset, line number, character identifier and word of each variable."""
+        for (offset, line), (surname, word) in zip(self.locations(), self.slots):
+            yield part, offset, line, surname, word
+
+    def locations(self):
+        """The offset and line number of each variable in the original text."""
+        offset = 0
+        line = 1
+
+        for literal, length in zip(self.literals, self.lengths):
+            offset += len(literal)
+            line += literal.count("\n")
+            yield offset, line
+            offset += length
+
+    def render(self, table):
+        get = table.variants.get
+        unknown = table.UNKNOWN
+
+        parts = [None] * (len(self.literals) + len(self.keys))
+        parts[0::2] = self.literals
+        parts[1::2] = [get(key, unknown)[case] for key, case in self.keys]
+        return "".join(parts)
+
+    def signature(self, table):
+        """A checksum of the substitutions from table which rendering this template would use. Tables with the same signature render the template to the same text."""
+        if self.distinct_keys is None:
+            self.distinct_keys = sorted(set(self.keys))
+
+        get = table.variants.get
+        unknown = table.UNKNOWN
+        return checksum(json.dumps([[key, case, get(key, unknown)[case]] for key, case in self.distinct_keys]))
+
+    def usage(self, table, part=None, usage=None):
+        """The substitutions that rendering this template with table would make."""
+        if self.slot_counts is None:
+            self.slot_counts = collections.Counter(self.slots)
+
+        if usage is None:
+            usage = Usage()
+        unknown = set()
+
+        for slot, count in self.slot_counts.items():
+            surname = slot[0].lower()
+            usage.surnames.add(surname)
+            if SubstitutionTable.key(*slot)[0] in table.variants:
+                usage.counts[surname] = usage.counts.get(surname, 0) + count
+            else:
+                unknown.add(slot)
+
+        # Unknown variables should be rare, so they are only located if there are any
+        if unknown:
+            for (offset, line), slot in zip(self.locations(), self.slots):
+                if slot in unknown:
+                    usage.unknown.append([part, offset, line, "%s_%s" % slot])
+
+        return usage
+
+
+class PartsTemplate(object):
+    """Templates for each part of a zipped document, which together are used like a single template. Rendering gives the text of each part by name."""
+
+    def __init__(self, templates):
+        self.templates = templates
+        self.slots = [slot for name, template in templates for slot in template.slots]
+
+    def dumps(self):
+        return json.dumps({"parts": [(name, template.to_dict()) for name, template in self.templates]})
+
+    def occurrences(self):
+        for name, template in self.templates:
+            yield from template.occurrences(name)
+
+    def render(self, table):
+        return dict((name, template.render(table)) for name, template in self.templates)
+
+    def signature(self, table):
+        return checksum(":".join(template.signature(table) for name, template in self.templates))
+
+    def usage(self, table):
+        usage = Usage()
+        for name, template in self.templates:
+            template.usage(table, name, usage)
+        return usage
+
+
+class Usage(object):
+    """The substitutions made in one file for one cast: how many variables were replaced for each character, and where any unknown variables are."""
+
+    def __init__(self, counts=None, unknown=None):
+        self.surnames = set()
+        self.counts = counts or {}
+        # Each unknown variable is recorded as [part, offset, line, variable], where part is the name of the part of a zipped document it is in
+        self.unknown = unknown or []
+
+    def substitute(self, table, surname, word, locate, part=None):
+        """Look up a variable as it is found, recording its use. locate returns the offset and line number of the variable, and is only called if it is unknown."""
+        self.surnames.add(surname.lower())
+        key, case = table.key(surname, word)
+        variants = table.variants.get(key)
+
+        if variants is None:
+            self.unknown.append([part] + list(locate()) + ["%s_%s" % (surname, word)])
+            return table.UNKNOWN[case]
+
+        self.counts[surname.lower()] = self.counts.get(surname.lower(), 0) + 1
+        return variants[case]
+
+
+def checksum(text):
+    import hashlib
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class Stats(object):
+    """Wall time, bytes, variable matches and peak memory for each stage of processing each file."""
+    enabled = True
+    COLUMNS = ("seconds", "bytes", "matches", "peak_memory")
+
+    def __init__(self, memory=True):
+        self.records = []
+        self.memory = memory
+        # The highest memory use so far of each stage in progress, innermost last
+        self.peaks = []
+
+        import tracemalloc
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, stage, filename=None, cast=None):
+        record = {"stage": stage, "file": filename, "cast": cast, "bytes": 0, "matches": 0, "peak_memory": 0}
+
+        if self.memory:
+            import tracemalloc
+            baseline, peak = tracemalloc.get_traced_memory()
+            # Resetting the peak for a nested stage would lose the peak of the stage it is in, so that is kept first
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], peak)
+            tracemalloc.reset_peak()
+            self.peaks.append(baseline)
+        start = time.perf_counter()
+
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            if self.memory:
+                peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+                record["peak_memory"] = peak - baseline
+                if self.peaks:
+                    self.peaks[-1] = max(self.peaks[-1], peak)
+            self.records.append(record)
+
+    def by_stage(self):
+        stages = {}
+        for record in self.records:
+            total = stages.setdefault(record["stage"], {"stage": record["stage"], "count": 0, "seconds": 0, "bytes": 0, "matches": 0, "peak_memory": 0})
+            total["count"] += 1
+            total["seconds"] += record["seconds"]
+            total["bytes"] += record["bytes"]
+            total["matches"] += record["matches"]
+            total["peak_memory"] = max(total["peak_memory"], record["peak_memory"])
+        return list(stages.values())
+
+    def dump(self, outfile, output_format="table"):
+        if output_format == "json":
+            json.dump({"stages": self.by_stage(), "records": self.records}, outfile, indent=1, sort_keys=True)
+            outfile.write("\n")
+            return
+
+        rows = [("Stage", "File", "Count") + tuple(c.replace("_", " ").capitalize() for c in self.COLUMNS)]
+        for total in self.by_stage():
+            rows.append((total["stage"], "(all)", str(total["count"])) + self.format_columns(total))
+        for record in self.records:
+            if record["file"] is not None:
+                title = record["file"] if record["cast"] is None else "%s/%s" % (record["cast"], record["file"])
+                rows.append((record["stage"], title, "1") + self.format_columns(record))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            outfile.write("  ".join(cell.ljust(width) if i < 2 else cell.rjust(width) for i, (cell, width) in enumerate(zip(row, widths))).rstrip() + "\n")
+
+    def format_columns(self, record):
+        return ("%.4f" % record["seconds"], str(record["bytes"]), str(record["matches"]), str(record["peak_memory"]))
+
+
+class NullStats(object):
+    """Stands in for Stats when they are not being collected, at the cost of an empty context manager for each stage. The record it yields is shared, so nothing should be written to it unless stats are enabled."""
+    enabled = False
+    STAGE = contextlib.nullcontext({})
+
+    def stage(self, stage, filename=None, cast=None):
+        return self.STAGE
+
+
+NULL_STATS = NullStats()
+
+
+class TemplateCache(object):
+    """Templates stored on disk by the checksum of the document they came from, so that unchanged documents do not have to be read and scanned again. When the cache grows beyond max_size bytes the least recently used templates are removed."""
+    DIRNAME = ".genderiser-cache"
+    VERSION = 5
+
+    def __init__(self, project_dir, max_size):
+        self.path = os.path.join(project_dir, self.DIRNAME, "templates")
+        self.max_size = max_size
+        # Recently used templates are also kept in memory, up to max_size bytes of their stored size, for processes which render more than once
+        self.recent = collections.OrderedDict()
+        self.recent_size = 0
+
+    def __getstate__(self):
+        # Worker processes start with nothing in memory
+        state = dict(self.__dict__)
+        state["recent"] = collections.OrderedDict()
+        state["recent_size"] = 0
+        return state
+
+    def key(self, input_checksum, regex):
+        return checksum("%d:%s:%s" % (self.VERSION, input_checksum, regex.pattern))
+
+    def remember(self, key, template, size):
+        if key not in self.recent:
+            self.recent[key] = (template, size)
+            self.recent_size += size
+        self.recent.move_to_end(key)
+
+        while self.recent_size > self.max_size:
+            template, size = self.recent.popitem(last=False)[1]
+            self.recent_size -= size
+
+    def get(self, key):
+        path = os.path.join(self.path, key)
+
+        if key in self.recent:
+            template = self.recent[key][0]
+            self.recent.move_to_end(key)
+        else:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    data = f.read()
+                template = Template.loads(data)
+            except (EnvironmentError, ValueError, KeyError, TypeError):
+                return None
+            self.remember(key, template, len(data))
+
+        # The modification time records when each template was last used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return template
+
+    def put(self, key, template):
+        path = os.path.join(self.path, key)
+        temppath = "%s.%d.tmp" % (path, os.getpid())
+        data = template.dumps()
+        self.remember(key, template, len(data))
+
+        # The cache is only an optimisation, so a project directory which can't be written to is rendered without it
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path, exist_ok=True)
+            with open(temppath, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(temppath, path)
+        except OSError:
+            try:
+                os.remove(temppath)
+            except OSError:
+                pass
+
+    def evict(self):
+        try:
+            entries = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in os.scandir(self.path) if e.is_file()]
+        except OSError:
+            return
+
+        size = sum(entry[1] for entry in entries)
+
+        for mtime, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+
+
+def stream_sub(regex, chunks, repl, margin=1024, locate=False):
+    """Like regex.sub, but for text which arrives in chunks. The result is yielded in pieces. Text near the end of what has been read so far is held back in case a variable continues in the next chunk, so variables may not be longer than margin characters.
+
+    If locate is true, repl is also passed a function which returns the offset and line number of the match in the whole text."""
+    pending = ""
+    # The offset and line number of the start of pending
+    base = 0
+    line = 1
+
+    if locate:
+        def sub(m):
+            return repl(m, lambda: (base + m.start(), line + pending.count("\n", 0, m.start())))
+    else:
+        sub = repl
+
+    for chunk in chunks:
+        pending += chunk
+        limit = len(pending) - margin
+        if limit <= 0:
+            continue
+
+        parts = []
+        pos = 0
+        cut = limit
+
+        for m in regex.finditer(pending):
+            if m.start() >= limit:
+                break
+            if m.end() == len(pending):
+                # This variable may continue in the next chunk
+                cut = m.start()
+                break
+            parts.append(pending[pos:m.start()])
+            parts.append(sub(m))
+            pos = m.end()
+
+        cut = max(cut, pos)
+        parts.append(pending[pos:cut])
+        if locate:
+            base += cut
+            line += pending.count("\n", 0, cut)
+        pending = pending[cut:]
+        yield "".join(parts)
+
+    yield regex.sub(sub, pending)
+
+
+XML_TAG = re.compile("<[^>]*>")
+XML_SPLIT = re.compile("(<[^>]*>)")
+
+
+def xml_parts(xml, hidden=None):
+    """Split XML into a list which alternates between text and tags. An element whose start tag matches hidden, such as deleted text in a document with tracked changes, is kept whole as one tag, so that its contents are not taken as text. Also returns the offset of the start of such an element if it is not closed, or None."""
+    parts = XML_SPLIT.split(xml)
+    if hidden is None or hidden.search(xml) is None:
+        return parts, None
+
+    merged = [parts[0]]
+    offset = len(parts[0])
+    opened = None
+    close = None
+    for i in range(1, len(parts), 2):
+        tag, text = parts[i], parts[i + 1]
+        if close is not None:
+            merged[-1] += tag
+            if tag == close:
+                close = None
+                merged.append(text)
+            else:
+                merged[-1] += text
+        else:
+            m = hidden.match(tag)
+            merged.append(tag)
+            if m and not tag.endswith("/>"):
+                close = "</%s>" % m.group(1)
+                opened = offset
+                merged[-1] += text
+            else:
+                merged.append(text)
+        offset += len(tag) + len(text)
+
+    return merged, opened if close is not None else None
+
+
+def xml_tokens(regex, chunks, break_tag, margin=1024, hidden=None):
+    """Split XML which arrives in chunks into literal XML and variables. Variables are matched in the text between tags, so a variable which a word processor has split across several runs is still found. Tags which match break_tag, such as the end of a paragraph, separate text which cannot be part of the same variable. The contents of elements whose start tag matches hidden are not text, and are treated as part of the tags (see xml_parts).
+
+    Literal XML is yielded as strings, and each variable as a tuple of its match in the text, the length of the variable's text and the tags inside it, and a function which returns the variable's offset and line number. Tags inside a variable are kept, after the variable, and the text of the variable is removed from them. As in stream_sub, text near the end of what has been read so far is held back, so variables may not be longer than margin characters."""
+    pending = ""
+    # The offset and line number of the start of pending
+    base = 0
+    line = 1
+
+    def locator(start):
+        return lambda: (base + start, line + pending.count("\n", 0, start))
+
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        end = len(pending)
+
+        if not final:
+            pending += chunk
+            if len(pending) <= margin:
+                continue
+            # Leave any unfinished tag until the rest of it has been read
+            end = len(pending)
+            lt = pending.rfind("<")
+            if lt != -1 and pending.find(">", lt) == -1:
+                end = lt
+
+        parts, opened = xml_parts(pending[:end], hidden)
+        if opened is not None and not final:
+            # Likewise leave a hidden element until the end of it has been read
+            end = opened
+            parts = xml_parts(pending[:end], hidden)[0]
+
+        # Each tag becomes a NUL in the text if it is a break and disappears if it is not
+        pieces = parts[:]
+        pieces[1::2] = ["\0" if break_tag.match(tag) else "" for tag in parts[1::2]]
+        text = "".join(pieces)
+        xml_starts = list(itertools.accumulate(map(len, parts), initial=0))
+        text_starts = list(itertools.accumulate(map(len, pieces), initial=0))
+
+        def xml_pos(i):
+            k = bisect.bisect_right(text_starts, i) - 1
+            return xml_starts[k] + i - text_starts[k]
+
+        # No variable continues past a break, so everything before the last one is complete
+        limit = len(text) if final else max(len(text) - margin, text.rfind("\0") + 1)
+        cut = limit
+        pos = 0
+
+        for m in regex.finditer(text):
+            if not final:
+                if m.start() >= limit:
+                    break
+                if m.end() == len(text):
+                    # This variable may continue in the next chunk
+                    cut = m.start()
+                    break
+            start = xml_pos(m.start())
+            stop = xml_pos(m.end() - 1) + 1
+            if start > pos:
+                yield pending[pos:start]
+            tags = ""
+            if pending.find("<", start, stop) != -1:
+                # Tags are at the odd indices of parts
+                first = bisect.bisect_left(xml_starts, start)
+                tags = "".join(parts[k] for k in range(first + 1 - first % 2, bisect.bisect_left(xml_starts, stop), 2))
+            yield m, stop - start - len(tags), locator(start)
+            if tags:
+                yield tags
+            pos = stop
+
+        cut = len(pending) if final else max(xml_pos(cut), pos)
+        if cut > pos:
+            yield pending[pos:cut]
+        base += cut
+        line += pending.count("\n", 0, cut)
+        pending = pending[cut:]
+
+
+def location(filename, part):
+    """How to refer to a part of a zipped document, or to a plain file if part is None."""
+    return filename if part is None else "%s:%s" % (filename, part)
+
+
+class VariableIndex(object):
+    """Every variable used in each file, with its location. The index can be kept on disk, in which case only files which have changed since it was last updated are scanned again."""
+    FILENAME = "index.json"
+    VERSION = 3
+    # As with DirectoryListings, files changed this recently may change again within the resolution of their modification time, so their signatures are not kept
+    RACY_NS = 2 * 10 ** 9
+
+    def __init__(self, path=None):
+        self.path = path
+        self.pattern = None
+        self.entries = {}
+
+    def load(self):
+        if self.path is None:
+            return self
+
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                index = json.load(f)
+            if index["version"] != self.VERSION:
+                raise ValueError("Unsupported index version.")
+            self.pattern = index["pattern"]
+            self.entries = index["files"]
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            self.pattern = None
+            self.entries = {}
+        return self
+
+    def save(self):
+        # Like the template cache, the index is only kept if the project directory can be written to
+        temppath = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            indexdir = os.path.dirname(self.path)
+            if not os.path.exists(indexdir):
+                os.makedirs(indexdir, exist_ok=True)
+            with open(temppath, "w", encoding="utf-8") as f:
+                json.dump({"version": self.VERSION, "pattern": self.pattern, "files": self.entries}, f)
+            os.replace(temppath, self.path)
+        except OSError:
+            try:
+                os.remove(temppath)
+            except OSError:
+                pass
+
+    def update(self, filehelpers, regex, cache=None, stats=NULL_STATS):
+        """Scan any files which have changed, and forget files which are no longer in the project."""
+        if regex.pattern != self.pattern:
+            self.pattern = regex.pattern
+            self.entries = {}
+
+        entries = {}
+        changed = False
+
+        for filehelper in filehelpers:
+            with filehelper:
+                signature = filehelper.signature()
+                entry = self.entries.get(filehelper.filename)
+
+                if entry is None or entry["signature"] != signature:
+                    template = filehelper.load_template(regex, cache, stats)
+                    if time.time_ns() - signature[1] <= self.RACY_NS:
+                        # Scanned again next time, whatever its signature is then
+                        signature = None
+                    entry = {"signature": signature, "occurrences": list(template.occurrences())}
+                    changed = True
+
+            entries[filehelper.filename] = entry
+
+        changed = changed or set(entries) != set(self.entries)
+        self.entries = entries
+
+        if changed and self.path is not None:
+            self.save()
+
+    def occurrences(self):
+        for filename, entry in self.entries.items():
+            for part, offset, line, surname, word in entry["occurrences"]:
+                yield filename, part, offset, line, surname, word
+
+
+def path_pattern(pattern):
+    """A regular expression for a pattern of paths relative to the project directory, separated by /. * and ? match within a directory, and **/ matches any number of directories."""
+    regex = []
+    for piece in re.split(r"(\*\*/|\*\*|\*|\?)", pattern.strip().replace(os.sep, "/")):
+        if piece == "**/":
+            regex.append("(?:.*/)?")
+        elif piece == "**":
+            regex.append(".*")
+        elif piece == "*":
+            regex.append("[^/]*")
+        elif piece == "?":
+            regex.append("[^/]")
+        else:
+            regex.append(re.escape(piece))
+    return re.compile("".join(regex) + r"\Z")
+
+
+class DirectoryListings(object):
+    """The entries of each directory in a project, kept between runs with the modification time of the directory, so that directories which have not changed do not have to be listed again."""
+    FILENAME = "listings.json"
+    VERSION = 1
+    # Directories changed this recently may change again within the resolution of their modification time, so their listings are not kept
+    RACY_NS = 2 * 10 ** 9
+
+    def __init__(self, path=None):
+        self.path = path
+        self.listings = {}
+        self.changed = False
+
+    def load(self):
+        if self.path is None:
+            return self
+
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                listings = json.load(f)
+            if listings["version"] != self.VERSION:
+                raise ValueError("Unsupported listings version.")
+            self.listings = listings["directories"]
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            self.listings = {}
+        return self
+
+    def save(self):
+        if self.path is None or not self.changed:
+            return
+
+        temppath = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            listingsdir = os.path.dirname(self.path)
+            if not os.path.exists(listingsdir):
+                os.makedirs(listingsdir, exist_ok=True)
+            with open(temppath, "w", encoding="utf-8") as f:
+                json.dump({"version": self.VERSION, "directories": self.listings}, f)
+            os.replace(temppath, self.path)
+            self.changed = False
+        except OSError:
+            try:
+                os.remove(temppath)
+            except OSError:
+                pass
+
+    def entries(self, path, relpath):
+        """The name of each entry in a directory, and whether it is a directory itself, in sorted order."""
+        mtime = os.stat(path).st_mtime_ns
+        listing = self.listings.get(relpath)
+        if listing is not None and listing[0] == mtime:
+            return listing[1]
+
+        with os.scandir(path) as scan:
+            # Links to directories are not followed, so that links cannot make the walk go round in circles
+            entries = sorted([entry.name, entry.is_dir(follow_symlinks=False)] for entry in scan)
+
+        if time.time_ns() - mtime > self.RACY_NS:
+            self.listings[relpath] = [mtime, entries]
+            self.changed = True
+        elif relpath in self.listings:
+            del self.listings[relpath]
+            self.changed = True
+
+        return entries
+
+    def walk(self, top, exclude=(), skip=()):
+        """The relative path, separated by /, and full path of each file under top, depth first in sorted order. Hidden files and directories, directories which hold a render manifest, and directories whose relative paths are in skip or match a regex in exclude are left out."""
+        stack = [("", top)]
+
+        while stack:
+            relpath, path = stack.pop()
+            entries = self.entries(path, relpath)
+
+            # Output directories are recognised by their manifests, so that outputs are never read as documents
+            if relpath and [Manifest.FILENAME, False] in entries:
+                continue
+
+            # The files in each directory come before its subdirectories, which are visited in sorted order
+            subdirs = []
+            for name, is_dir in entries:
+                if name.startswith("."):
+                    continue
+
+                entry_relpath = relpath + name
+                entry_path = os.path.join(path, name)
+
+                if is_dir:
+                    if entry_relpath not in skip and not any(regex.match(entry_relpath) or regex.match(entry_relpath + "/") for regex in exclude):
+                        subdirs.append((entry_relpath + "/", entry_path))
+
+                elif not any(regex.match(entry_relpath) for regex in exclude):
+                    yield entry_relpath, entry_path
+
+            stack.extend(reversed(subdirs))
+
+        # Listings are only saved once the whole project has been walked
+        self.save()
+
+
+def copy_zip_member(zipped_infile, zipped_outfile, fileinfo, bufsize=1024 * 1024):
+    """Copy a member from one open zip file to another without decompressing and recompressing it."""
+    import copy
+    import struct
+    import zipfile
+
+    infile = zipped_infile.fp
+    outfile = zipped_outfile.fp
+
+    # Skip the local header; the compressed data follows it
+    infile.seek(fileinfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, infile.read(zipfile.sizeFileHeader))
+    infile.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    # The sizes and CRC are already known, so they go in the new local header rather than in a data descriptor
+    outinfo = copy.copy(fileinfo)
+    outinfo.flag_bits &= ~0x08
+    outinfo.extra = zipfile._strip_extra(fileinfo.extra, (1,))
+    zip64 = fileinfo.file_size > zipfile.ZIP64_LIMIT or fileinfo.compress_size > zipfile.ZIP64_LIMIT
+
+    outfile.seek(zipped_outfile.start_dir)
+    outinfo.header_offset = outfile.tell()
+    outfile.write(outinfo.FileHeader(zip64))
+
+    remaining = fileinfo.compress_size
+    while remaining:
+        data = infile.read(min(remaining, bufsize))
+        if not data:
+            raise GenderiserError("Unexpected end of data in %r." % fileinfo.filename)
+        outfile.write(data)
+        remaining -= len(data)
+
+    # Register the member so that it is written to the central directory when the output is closed
+    zipped_outfile.start_dir = outfile.tell()
+    zipped_outfile.filelist.append(outinfo)
+    zipped_outfile.NameToInfo[outinfo.filename] = outinfo
+    zipped_outfile._didModify = True
+
+
 class FileHelper(object):
-    def __init__(self, inpath, inputdir):
+    def __init__(self, inpath, inputdir, infile=None):
         self.inpath = inpath
         self.inputdir = inputdir
-        self.filename = os.path.relpath(inpath, inputdir)
+        # Documents held in memory have no path
+        self.filename = os.path.relpath(inpath, inputdir) if inpath is not None else None
+
+        # The file is opened once, when its type is detected, and the handle is kept until the file has been processed
+        self.infile = infile
 
         self.text = None
+        self.input_checksum = None
+
+    # Text modes other than "memory" which this type of file can be processed in
+    STREAM_MODES = ()
+    CHUNKSIZE = 1024 * 1024
+    # Roughly how many copies of a document's text are in memory while it is rendered: as read, as a template and as rendered
+    TEXT_COPIES = 3
+
+    def __getstate__(self):
+        # Open files can't be sent to worker processes; they are opened again when they are needed
+        state = dict(self.__dict__)
+        state["infile"] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        if self.infile is None:
+            self.infile = open(self.inpath, "rb")
+        return self.infile
+
+    def close(self):
+        if self.infile is not None:
+            self.infile.close()
+            self.infile = None
 
     def read(self):
         raise NotImplementedError()
 
+    def tokenize(self, regex):
+        return Template.from_text(regex, self.text)
+
+    def checksum(self, bufsize=1024 * 1024):
+        if self.input_checksum is None:
+            import hashlib
+            h = hashlib.sha1()
+            f = self.open()
+            f.seek(0)
+            for data in iter(lambda: f.read(bufsize), b""):
+                h.update(data)
+            self.input_checksum = h.hexdigest()
+        return self.input_checksum
+
+    def signature(self):
+        """The size and modification time of the file, a cheap way to notice that it has changed."""
+        st = os.stat(self.inpath)
+        return [st.st_size, st.st_mtime_ns]
+
+    def load_template(self, regex, cache=None, stats=NULL_STATS):
+        """Split the file into a template, reusing a cached template if the file has not changed."""
+        template = None
+
+        if cache is not None:
+            key = cache.key(self.checksum(), regex)
+            with stats.stage("cache", self.filename) as record:
+                template = cache.get(key)
+                if template is not None and stats.enabled:
+                    record["matches"] = len(template.slots)
+
+        if template is None:
+            with stats.stage("read", self.filename) as record:
+                self.read()
+                if stats.enabled:
+                    record["bytes"] = os.path.getsize(self.inpath)
+
+            with stats.stage("scan", self.filename) as record:
+                template = self.tokenize(regex)
+                if stats.enabled:
+                    record["matches"] = len(template.slots)
+
+            if cache is not None:
+                cache.put(key, template)
+
+        return template
+
     def plain_text(self):
         raise NotImplementedError()
         
     def write(self, outputdir):
+        with open(self.outpath(outputdir), "wb") as outfile:
+            self.write_to(outfile)
+
+    def write_to(self, outfile):
+        """Write the substituted document to an open binary file."""
         raise NotImplementedError()
 
+    def stream(self, outputdir, regex, table, mode="stream"):
+        """Substitute variables and write the output without holding the whole file in memory, in one of STREAM_MODES. Returns the Usage of the substitutions made."""
+        raise NotImplementedError()
+
+    def text_size(self):
+        """The size in bytes of the text which is read into memory to render the file."""
+        return os.path.getsize(self.inpath)
+
+    def memory_estimate(self, text_mode="memory"):
+        """Roughly how many bytes of memory rendering the file in this text mode will take."""
+        if text_mode in self.STREAM_MODES:
+            return self.CHUNKSIZE * self.TEXT_COPIES
+        return self.text_size() * self.TEXT_COPIES
+
+    def outpath(self, outputdir):
+        outpath = os.path.join(outputdir, self.filename)
+        
+        outfiledir = os.path.dirname(outpath)                
+        if not os.path.exists(outfiledir):
+            os.makedirs(outfiledir)
+
+        # An existing output may be a hard link to the output for another cast, so it is replaced rather than overwritten
+        if os.path.lexists(outpath):
+            os.remove(outpath)
+
+        return outpath
+
     @classmethod
     def is_text(cls, inpath):
+        with open(inpath, "rb") as f:
+            return cls.is_text_header(f.read(512))
+
+    @classmethod
+    def is_text_header(cls, s):
         """Cribbed from https://stackoverflow.com/questions/1446549/how-to-identify-binary-and-text-files-using-python"""
         is_text = True
 
-        with open(inpath, "rb") as f:
-            s = f.read(512)
-        
         if not s:
             is_text = True
         elif b"\0" in s:
@@ -56,97 +957,726 @@ class FileHelper(object):
 
     @classmethod
     def get_helper(cls, inpath, inputdir):
-        if zipfile.is_zipfile(inpath):
-            with zipfile.ZipFile(inpath, "r") as zipped_infile:
-                filelist = zipped_infile.infolist()
-
-            for ziphelper in (OdtFileHelper, DocxFileHelper):
-                if ziphelper.CONTENTFILE in [f.filename for f in filelist]:
-                    return ziphelper(inpath, inputdir)
-            raise GenderiserError("Unable to detect file type of %r." % inpath)
-        elif cls.is_text(inpath):
-            return TextFileHelper(inpath, inputdir)
+        infile = open(inpath, "rb")
+
+        try:
+            return cls.from_file(infile, inpath, inputdir)
+        except BaseException:
+            infile.close()
+            raise
+
+    @classmethod
+    def from_file(cls, infile, inpath=None, inputdir=None):
+        """A helper for an open binary file, which the helper keeps. inpath may be None for a document held in memory."""
+        # Sniff the header and, for zip files, the list of members from the one open file
+        header = infile.read(512)
+        name = inpath if inpath is not None else "document"
+
+        if header.startswith(b"PK"):
+            import zipfile
+            try:
+                zipped_infile = zipfile.ZipFile(infile)
+            except zipfile.BadZipFile:
+                zipped_infile = None
+
+            if zipped_infile is not None:
+                filenames = set(zipped_infile.namelist())
+
+                for ziphelper in (OdtFileHelper, DocxFileHelper):
+                    if ziphelper.CONTENTFILE in filenames:
+                        return ziphelper(inpath, inputdir, infile, zipped_infile)
+                raise GenderiserError("Unable to detect file type of %r." % name)
+
+        if cls.is_text_header(header):
+            return TextFileHelper(inpath, inputdir, infile)
+        else:
+            raise GenderiserError("Unable to detect file type of %r." % name)
+
+
+def write_buffers(fd, buffers, batch_size=1024):
+    """Write a list of buffers to a file descriptor with as few system calls as possible, using os.writev where it is available."""
+    writev = getattr(os, "writev", None)
+    i = 0
+
+    while i < len(buffers):
+        if writev is not None:
+            written = writev(fd, buffers[i:i + batch_size])
         else:
-            raise GenderiserError("Unable to detect file type of %r." % inpath)
+            written = os.write(fd, buffers[i])
+        # Skip the buffers which were written in full, and continue from the end of any which was only written in part
+        while i < len(buffers) and written >= len(buffers[i]):
+            written -= len(buffers[i])
+            i += 1
+        if written:
+            buffers[i] = buffers[i][written:]
 
 
 class TextFileHelper(FileHelper):
+    STREAM_MODES = ("stream", "mmap")
+
+    def text_infile(self):
+        # The text wrapper is detached after use, so that it does not close the file
+        infile = self.open()
+        infile.seek(0)
+        return io.TextIOWrapper(infile)
+
     def read(self):
-        with open(self.inpath, "r") as infile:
-            self.text = infile.read()
+        infile = self.text_infile()
+        self.text = infile.read()
+        infile.detach()
 
     def plain_text(self):
         return self.text
         
-    def write(self, outputdir):
-        outpath = os.path.join(outputdir, self.filename)
-        
-        outfiledir = os.path.dirname(outpath)                
-        if not os.path.exists(outfiledir):
-            os.makedirs(outfiledir)
+    def write_to(self, outfile):
+        # The text wrapper is detached after use, so that it does not close the file
+        outfile = io.TextIOWrapper(outfile)
+        outfile.write(self.text)
+        outfile.detach()
+
+    def stream(self, outputdir, regex, table, mode="stream"):
+        """Substitute variables and write the output a chunk at a time, without holding the whole file in memory. Returns the Usage of the substitutions made."""
+        if mode == "mmap":
+            return self.stream_mmap(outputdir, regex, table)
+
+        usage = Usage()
+
+        def var_sub(m, locate):
+            return usage.substitute(table, m.group(1), m.group(2), locate)
+
+        infile = self.text_infile()
+
+        with open(self.outpath(outputdir), "w") as outfile:
+            chunks = iter(lambda: infile.read(self.CHUNKSIZE), "")
+            for text in stream_sub(regex, chunks, var_sub, locate=True):
+                outfile.write(text)
+
+        infile.detach()
+        return usage
+
+    def stream_mmap(self, outputdir, regex, table):
+        """Substitute variables by scanning a memory map of the file, and write slices of the map between the replacements, so that the text is never copied or decoded. The file must be in an ASCII compatible encoding, and is written byte for byte, so line endings are not translated. Offsets of unknown variables are in bytes."""
+        import locale
+        import mmap
+
+        usage = Usage()
+        encoding = locale.getpreferredencoding(False)
+        bytes_regex = re.compile(regex.pattern.encode(encoding), regex.flags & ~re.UNICODE)
+        infile = self.open()
+
+        with open(self.outpath(outputdir), "wb") as outfile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                return usage
+
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # Unknown variables are located by counting lines from the last one found
+                counted = [0, 1]
+
+                def locate(start):
+                    def locator():
+                        counted[1] += mapped[counted[0]:start].count(b"\n")
+                        counted[0] = start
+                        return start, counted[1]
+                    return locator
+
+                view = memoryview(mapped)
+                # The replacement for each distinct variable that is known, and how many more times it is used
+                replacements = {}
+                repeats = {}
+                buffers = []
+                pos = 0
+
+                for m in bytes_regex.finditer(mapped):
+                    groups = m.group(1, 2)
+                    replacement = replacements.get(groups)
+
+                    if replacement is None:
+                        surname, word = groups[0].decode(encoding), groups[1].decode(encoding)
+                        value = usage.substitute(table, surname, word, locate(m.start()))
+                        replacement = value.encode(encoding)
+                        # Unknown variables are looked up every time, so that each use is located
+                        if table.key(surname, word)[0] in table.variants:
+                            replacements[groups] = replacement
+                            repeats[groups] = 0
+                    else:
+                        repeats[groups] += 1
+
+                    buffers.append(view[pos:m.start()])
+                    buffers.append(replacement)
+                    pos = m.end()
+
+                    if len(buffers) >= 1024:
+                        write_buffers(outfile.fileno(), buffers)
+                        buffers = []
+
+                buffers.append(view[pos:])
+                write_buffers(outfile.fileno(), buffers)
+
+                for (surname, word), count in repeats.items():
+                    surname = surname.decode(encoding).lower()
+                    usage.counts[surname] += count
+
+                # The map can only be closed once nothing refers to it
+                del buffers
+                view.release()
+
+        return usage
+
+
+class UnreadableFileHelper(FileHelper):
+    """Stands in for a document which could not be opened or whose type could not be detected, so that the error is recorded when the document is processed instead of stopping the other documents."""
+
+    def __init__(self, inpath, inputdir, error):
+        super(UnreadableFileHelper, self).__init__(inpath, inputdir)
+        self.error = error
+
+    def open(self):
+        raise self.error
 
-        with open(outpath, "w") as outfile:
-            outfile.write(self.text)
+    def read(self):
+        raise self.error
+
+    def memory_estimate(self, text_mode="memory"):
+        return 0
 
 
 class ZippedXMLFileHelper(FileHelper):
-    XML_TAG = re.compile("<[^>]*>")
+    XML_TAG = XML_TAG
+    # Elements whose contents are not part of the text, such as tracked changes
+    HIDDEN_TAG = None
+    ENCODING = "utf-8"
+    STREAM_MODES = ("stream",)
+
+    def __init__(self, inpath, inputdir, infile=None, zipped_infile=None):
+        super(ZippedXMLFileHelper, self).__init__(inpath, inputdir, infile)
+        self.zipped_infile = zipped_infile
+
+    def __getstate__(self):
+        state = super(ZippedXMLFileHelper, self).__getstate__()
+        state["zipped_infile"] = None
+        return state
+
+    def open_zip(self):
+        if self.zipped_infile is None:
+            import zipfile
+            self.zipped_infile = zipfile.ZipFile(self.open())
+        return self.zipped_infile
+
+    def close(self):
+        if self.zipped_infile is not None:
+            self.zipped_infile.close()
+            self.zipped_infile = None
+        super(ZippedXMLFileHelper, self).close()
+
+    def parts(self):
+        """The names of the parts of the document which may contain variables: the content file first, then any others matching PARTS in the order they are stored."""
+        names = [name for name in self.open_zip().namelist() if name != self.CONTENTFILE and any(fnmatch.fnmatchcase(name, pattern) for pattern in self.PARTS)]
+        return [self.CONTENTFILE] + names
+
+    def text_size(self):
+        # Other members, such as images, are copied without being read into memory
+        parts = set(self.parts())
+        return sum(info.file_size for info in self.open_zip().infolist() if info.filename in parts)
 
     def read(self):
-        with zipfile.ZipFile(self.inpath) as zipped_infile:
-            with zipped_infile.open(self.CONTENTFILE, "r") as contentfile:
-                contentfile = io.TextIOWrapper(contentfile)
-                self.text = contentfile.read()
+        zipped_infile = self.open_zip()
+        self.text = {}
+
+        for name in self.parts():
+            with zipped_infile.open(name, "r") as partfile:
+                self.text[name] = io.TextIOWrapper(partfile, encoding=self.ENCODING).read()
+
+    def tokenize(self, regex):
+        return PartsTemplate([(name, Template.from_xml(regex, text, self.BREAK_TAG, self.HIDDEN_TAG)) for name, text in self.text.items()])
 
     def plain_text(self):
-        return self.XML_TAG.sub("", self.text)
+        return "\n".join("".join(xml_parts(text, self.HIDDEN_TAG)[0][::2]) for text in self.text.values())
         
-    def write(self, outputdir):
-        outpath = os.path.join(outputdir, self.filename)
-        
-        outfiledir = os.path.dirname(outpath)                
-        if not os.path.exists(outfiledir):
-            os.makedirs(outfiledir)
+    def write(self, outputdir, substitute=None):
+        with open(self.outpath(outputdir), "wb") as outfile:
+            self.write_to(outfile, substitute)
+
+    def write_to(self, outfile, substitute=None):
+        import copy
+        import zipfile
+
+        parts = set(self.parts())
+
+        # Stream the zip to its new location, replacing only the parts which may contain variables. All other members are copied as they are, in their original order and with their original compression.
+        zipped_infile = self.open_zip()
+
+        with zipfile.ZipFile(outfile, "w") as zipped_outfile:
+            for fileinfo in zipped_infile.infolist():
+                if fileinfo.filename not in parts:
+                    copy_zip_member(zipped_infile, zipped_outfile, fileinfo)
+                elif substitute is None:
+                    zipped_outfile.writestr(copy.copy(fileinfo), self.text[fileinfo.filename].encode(self.ENCODING))
+                else:
+                    with zipped_infile.open(fileinfo) as partfile, zipped_outfile.open(copy.copy(fileinfo), "w") as outfile:
+                        substitute(fileinfo.filename, io.TextIOWrapper(partfile, encoding=self.ENCODING), outfile)
+
+    def stream(self, outputdir, regex, table, mode="stream"):
+        """Substitute variables in each part as it is read and written, without holding it in memory. Returns the Usage of the substitutions made."""
+        usage = Usage()
+
+        def substitute(name, infile, outfile):
+            chunks = iter(lambda: infile.read(self.CHUNKSIZE), "")
+            for item in xml_tokens(regex, chunks, self.BREAK_TAG, hidden=self.HIDDEN_TAG):
+                if isinstance(item, str):
+                    outfile.write(item.encode(self.ENCODING))
+                else:
+                    m, length, locate = item
+                    outfile.write(usage.substitute(table, m.group(1), m.group(2), locate, name).encode(self.ENCODING))
+
+        self.write(outputdir, substitute)
+        return usage
+
+
+class OdtFileHelper(ZippedXMLFileHelper):
+    CONTENTFILE = "content.xml"
+    # Headers and footers are kept with the page styles
+    PARTS = ("styles.xml",)
+    BREAK_TAG = re.compile(r"</text:[ph]>|<text:(s|tab|line-break)\b")
+    HIDDEN_TAG = re.compile(r"<(text:tracked-changes)\b")
+
+
+class DocxFileHelper(ZippedXMLFileHelper):
+    CONTENTFILE = "word/document.xml"
+    PARTS = ("word/header*.xml", "word/footer*.xml", "word/footnotes.xml", "word/endnotes.xml", "word/comments.xml", "word/styles.xml")
+    BREAK_TAG = re.compile(r"</w:p>|<w:(tab|br|cr)\b")
+    # Deleted text, and the instructions of fields, which are shown by their results
+    HIDDEN_TAG = re.compile(r"<(w:delText|w:instrText)\b")
+
+
+class Manifest(object):
+    """Records what each file in an output directory was rendered from, so that unchanged files can be skipped on the next run.
 
-        # Surprisingly hard. Decompress the zip, overwrite content.xml, recompress the zip to a new location.
+    Each file's entry lists the characters it refers to, with a checksum of each character's substitutions. A file only needs to be rendered again if it has changed, or if one of the characters it refers to has. The entry also keeps the usage of the substitutions made, so that it can be reported for files which are skipped."""
+    FILENAME = ".genderiser-manifest.json"
+    VERSION = 4
 
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, self.FILENAME)
+        self.entries = {}
+        self.characters = None
+        self.genders = None
+
+    def load(self):
         try:
-            unzipped_tempdir = tempfile.mkdtemp()
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest["version"] != self.VERSION:
+                raise ValueError("Unsupported manifest version.")
+            self.entries = manifest["files"]
+            self.characters = manifest["characters"]
+            self.genders = manifest.get("genders")
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            # A missing or unreadable manifest just means that everything is rendered again
+            self.entries = {}
+            self.characters = None
+            self.genders = None
+        return self
+
+    def is_current(self, filename, input_checksum, regex_checksum, character_checksums):
+        entry = self.entries.get(filename)
+
+        if not entry or entry["input"] != input_checksum or entry["regex"] != regex_checksum:
+            return False
+
+        for surname, character_checksum in entry["characters"].items():
+            if character_checksums.get(surname, "") != character_checksum:
+                return False
+
+        return os.path.exists(os.path.join(self.output_dir, filename))
+
+    def changed_characters(self, character_checksums):
+        if self.characters is None:
+            return []
+        surnames = set(self.characters) | set(character_checksums)
+        return sorted(s for s in surnames if self.characters.get(s, "") != character_checksums.get(s, ""))
+
+    def save(self, entries, character_checksums, genders=None):
+        """Save the entries. genders, the gender of each character, is only recorded to show which cast the output directory is for."""
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        temppath = self.path + ".tmp"
+        with open(temppath, "w") as f:
+            json.dump({"version": self.VERSION, "characters": character_checksums, "genders": genders, "files": entries}, f, indent=1, sort_keys=True)
+        os.replace(temppath, self.path)
+
+        self.entries = entries
+        self.characters = character_checksums
+        self.genders = genders
+
+
+class Render(object):
+    """A cast to be rendered: its substitutions and the directory its output goes to."""
+
+    def __init__(self, name, characters, table, output_dir):
+        self.name = name
+        self.characters = characters
+        self.table = table
+        self.output_dir = output_dir
+        self.manifest = Manifest(output_dir)
+
+        # Checksums of each character's gender and substitutions, to detect which characters have changed since the last run
+        self.checksums = {}
+        for surname, gender in characters.items():
+            prefix = "%s_" % surname
+            character_subs = sorted((k, v) for (k, v) in table.subs.items() if k.startswith(prefix))
+            self.checksums[surname] = checksum(json.dumps([gender, character_subs]))
+
+    def title(self, filename):
+        return filename if self.name is None else "%s/%s" % (self.name, filename)
+
+
+class FileResult(object):
+    """The outcome of processing one file. Renders are referred to by index, so that they do not have to be sent back from worker processes."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.previews = []
+        self.rendered = []
+        self.skipped = []
+        # The Usage of each render, by index, for files which were rendered or previewed
+        self.usage = []
+        # Renders, by index, whose output was the same as an earlier cast's and was linked or copied from it, with the bytes saved
+        self.deduplicated = []
+        self.error = None
+        self.stats = []
+
+
+class Report(object):
+    """A summary of a call to Genderiser.replace."""
+
+    def __init__(self):
+        self.written = []
+        self.skipped = []
+        self.errors = []
+        self.changed_characters = []
+        # The number of variables replaced for each character in each cast, by cast name
+        self.counts = {}
+        # Each unknown variable is recorded as (title, part, offset, line, variable)
+        self.unknown = []
+        # Outputs which were linked or copied from an identical output for another cast, and the disk space saved by linking
+        self.deduplicated = []
+        self.saved_bytes = 0
+        # Outputs of documents which no longer exist, which were removed
+        self.removed = []
+
+    def add_usage(self, render, filename, usage):
+        counts = self.counts.setdefault(render.name, {})
+        for surname, count in usage.counts.items():
+            counts[surname] = counts.get(surname, 0) + count
+
+        title = render.title(filename)
+        for part, offset, line, variable in usage.unknown:
+            self.unknown.append((title, part, offset, line, variable))
+
+    def to_dict(self):
+        return {
+            "written": self.written,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "changed_characters": self.changed_characters,
+            "deduplicated": self.deduplicated,
+            "saved_bytes": self.saved_bytes,
+            "removed": self.removed,
+            "counts": [{"cast": name, "characters": counts} for name, counts in self.counts.items()],
+            "unknown": [{"file": title, "part": part, "offset": offset, "line": line, "variable": variable} for title, part, offset, line, variable in self.unknown],
+        }
 
-            with zipfile.ZipFile(self.inpath, "r") as zipped_infile:
-                zipped_infile.extractall(unzipped_tempdir)
-                filelist = zipped_infile.infolist()
+    @classmethod
+    def from_dict(cls, report):
+        self = cls()
+        for key in ("written", "skipped", "errors", "changed_characters", "deduplicated", "saved_bytes", "removed"):
+            setattr(self, key, report[key])
+        self.counts = dict((counts["cast"], counts["characters"]) for counts in report["counts"])
+        self.unknown = [(u["file"], u["part"], u["offset"], u["line"], u["variable"]) for u in report["unknown"]]
+        return self
+
+    def merge(self, other):
+        """Add the results of another report, for different casts, to this one."""
+        self.written.extend(other.written)
+        self.skipped.extend(other.skipped)
+        self.errors.extend(other.errors)
+        self.changed_characters = sorted(set(self.changed_characters) | set(other.changed_characters))
+        self.deduplicated.extend(other.deduplicated)
+        self.saved_bytes += other.saved_bytes
+        self.removed.extend(other.removed)
+        self.counts.update(other.counts)
+        self.unknown.extend(other.unknown)
+
+    def dump(self, outfile):
+        json.dump(self.to_dict(), outfile, indent=1, sort_keys=True)
+        outfile.write("\n")
+
+
+class Shard(object):
+    """One of count slices of the casts of a render, numbered from 1. Each shard renders every file for its casts, so that shards running at the same time on different machines write to different output directories and manifests.
+
+    A shard which finishes leaves a record of its casts and report in the output directory, which is checked and combined by Genderiser.merge_shards."""
+    DIRNAME = ".genderiser-shards"
+
+    def __init__(self, index, count):
+        if count < 1 or not 1 <= index <= count:
+            raise GenderiserError("Shard %d/%d does not exist." % (index, count))
+        self.index = index
+        self.count = count
 
-            with open(os.path.join(unzipped_tempdir, self.CONTENTFILE), "w") as outfile:
-                outfile.write(self.text)
+    @classmethod
+    def parse(cls, spec):
+        """Parse a shard given as index/count, e.g. 2/8."""
+        index, sep, count = spec.partition("/")
+        try:
+            return cls(int(index), int(count))
+        except ValueError:
+            raise GenderiserError("Shard %r is not of the form index/count." % spec)
 
-            with zipfile.ZipFile(outpath, "w") as zipped_outfile:
-                for fileinfo in filelist:
-                    filepath = fileinfo.filename
-                    datapath = os.path.join(unzipped_tempdir, filepath)
-                    zipped_outfile.write(datapath, filepath)
-        finally:
-            try:
-                shutil.rmtree(unzipped_tempdir)
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    raise
+    def casts(self, casts):
+        # Casts are dealt out in turn, so that casts which differ in one character are spread over the shards
+        return list(itertools.islice(casts, self.index - 1, None, self.count))
 
+    def path(self, output_dir):
+        return os.path.join(output_dir, self.DIRNAME, "%d-of-%d.json" % (self.index, self.count))
 
-class OdtFileHelper(ZippedXMLFileHelper):
-    CONTENTFILE = "content.xml"
+    def save(self, output_dir, casts, report):
+        path = self.path(output_dir)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
 
+        temppath = path + ".tmp"
+        with open(temppath, "w") as f:
+            json.dump({"casts": [name for name, characters in casts], "report": report.to_dict()}, f, indent=1, sort_keys=True)
+        os.replace(temppath, path)
+
+    def load(self, output_dir):
+        """The names of the casts rendered by this shard and its report, or None if it has not finished."""
+        try:
+            with open(self.path(output_dir)) as f:
+                record = json.load(f)
+            return record["casts"], Report.from_dict(record["report"])
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            return None
+
+
+class Job(object):
+    """Everything needed to process each file in a call to Genderiser.replace. This is sent to worker processes."""
+
+    def __init__(self, regex, renders, preview=False, force=False, cache=None, text_mode="memory", stats=False, dedup="link"):
+        self.regex = regex
+        self.renders = renders
+        self.preview = preview
+        self.force = force
+        self.cache = cache
+        self.text_mode = text_mode
+        # How to reuse an output which is the same for several casts: "link", "copy" or "none"
+        self.dedup = dedup
+        # Whether to collect stats; they are collected separately in each worker process
+        self.stats = stats
+
+
+def link_or_copy(source, target, mode="link"):
+    """Make target a hard link to source, or a copy of it if mode is "copy" or the link cannot be made. Returns True if it was linked."""
+    if mode == "link":
+        try:
+            os.link(source, target)
+            return True
+        except OSError:
+            pass
+
+    import shutil
+    shutil.copyfile(source, target)
+    return False
 
-class DocxFileHelper(ZippedXMLFileHelper):
-    CONTENTFILE = "word/document.xml"
+
+def process_file(filehelper, job):
+    """Read a file once and render it for each cast that is out of date. Errors are recorded in the result rather than raised, so that one bad file does not stop the others."""
+    result = FileResult(filehelper.filename)
+    stats = Stats() if job.stats else NULL_STATS
+
+    try:
+        if job.preview:
+            stale = list(enumerate(job.renders))
+        else:
+            # Skip any outputs which were rendered from the same input and regex, if none of the characters in them have changed
+            stale = []
+            with stats.stage("checksum", filehelper.filename) as record:
+                input_checksum = filehelper.checksum()
+                if stats.enabled:
+                    record["bytes"] = os.path.getsize(filehelper.inpath)
+            regex_checksum = checksum(job.regex.pattern)
+
+            for i, render in enumerate(job.renders):
+                if not job.force and render.manifest.is_current(filehelper.filename, input_checksum, regex_checksum, render.checksums):
+                    result.skipped.append(i)
+                else:
+                    stale.append((i, render))
+
+        # Large files can be substituted as they are read, once for each cast, instead of being read into memory
+        streaming = not job.preview and job.text_mode in filehelper.STREAM_MODES
+
+        if stale and not streaming:
+            # Read content and split it into text and variables once for all casts
+            template = filehelper.load_template(job.regex, job.cache, stats)
+
+        # Casts which use the same substitutions in this file give the same output, so it is only rendered and written once
+        dedup = not job.preview and not streaming and job.dedup != "none"
+        outputs = {}
+
+        for i, render in stale:
+            if streaming:
+                with stats.stage("stream", filehelper.filename, render.name) as record:
+                    usage = filehelper.stream(render.output_dir, job.regex, render.table, job.text_mode)
+                    if stats.enabled:
+                        record["bytes"] = os.path.getsize(os.path.join(render.output_dir, filehelper.filename))
+
+            else:
+                # Replace variables
+                with stats.stage("substitute", filehelper.filename, render.name) as record:
+                    signature = template.signature(render.table) if dedup else None
+                    if signature not in outputs:
+                        filehelper.text = template.render(render.table)
+                    usage = template.usage(render.table)
+                    if stats.enabled:
+                        record["matches"] = len(template.slots)
+
+            result.usage.append((i, usage))
+
+            if job.preview:
+                title = render.title(filehelper.filename)
+                with stats.stage("strip", filehelper.filename, render.name):
+                    plain_text = filehelper.plain_text().strip()
+                result.previews.append("%s:\n%s\n%s\n" % (title, "-" * (len(title) + 1), plain_text))
+
+            # Otherwise try to write to a file
+            else:
+                if streaming:
+                    pass
+
+                elif signature in outputs:
+                    with stats.stage("dedup", filehelper.filename, render.name) as record:
+                        source = outputs[signature]
+                        linked = link_or_copy(source, filehelper.outpath(render.output_dir), job.dedup)
+                        if stats.enabled:
+                            record["bytes"] = os.path.getsize(source)
+                    result.deduplicated.append((i, os.path.getsize(source) if linked else 0))
+
+                else:
+                    with stats.stage("write", filehelper.filename, render.name) as record:
+                        filehelper.write(render.output_dir)
+                        if stats.enabled:
+                            record["bytes"] = os.path.getsize(os.path.join(render.output_dir, filehelper.filename))
+                    if signature is not None:
+                        outputs[signature] = os.path.join(render.output_dir, filehelper.filename)
+                entry = {
+                    "input": input_checksum,
+                    "regex": regex_checksum,
+                    "characters": dict((surname, render.checksums.get(surname, "")) for surname in usage.surnames),
+                    "counts": usage.counts,
+                    "unknown": usage.unknown,
+                }
+                result.rendered.append((i, entry))
+
+    except Exception as e:
+        result.error = "%s: %s" % (filehelper.filename, e)
+
+    finally:
+        filehelper.close()
+
+    if stats.enabled:
+        result.stats = stats.records
+
+    return result
+
+
+# The Job being processed by a worker process of a Scheduler
+worker_job = None
+
+
+def start_worker(job):
+    global worker_job
+    worker_job = job
+
+
+def process_worker_file(filehelper):
+    return process_file(filehelper, worker_job)
+
+
+class Scheduler(object):
+    """Processes files in worker processes, with no more than workers files, and about budget bytes of their estimated memory use, in progress at once. Files are taken from discovery only as there is room to look ahead, and the largest file waiting goes first, so that large files do not hold up the end of a run. Results are yielded in the order the files were found.
+
+    Files waiting, in progress and finished but held behind an earlier file all count against the lookahead, so a slow file stops discovery, and the results held in memory, from running ahead of it."""
+    # How many files to look ahead for each worker
+    LOOKAHEAD = 8
+
+    def __init__(self, workers, budget=None):
+        self.workers = workers
+        self.budget = budget
+        self.lookahead = workers * self.LOOKAHEAD
+
+    def run(self, filehelpers, job):
+        import concurrent.futures
+
+        filehelpers = iter(filehelpers)
+        # Waiting files as (estimate, order, filehelper), kept sorted so that the largest is last
+        waiting = []
+        running = {}
+        finished = {}
+        found = 0
+        yielded = 0
+        in_progress = 0
+        exhausted = False
+
+        # The job is sent to each worker once, rather than with every file
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=start_worker, initargs=(job,)) as executor:
+            while True:
+                while not exhausted and found - yielded < self.lookahead:
+                    filehelper = next(filehelpers, None)
+                    if filehelper is None:
+                        exhausted = True
+                        break
+                    estimate = filehelper.memory_estimate(job.text_mode)
+                    # Worker processes open the file again
+                    filehelper.close()
+                    bisect.insort(waiting, (estimate, found, filehelper))
+                    found += 1
+
+                # The largest file waits for room rather than being overtaken, so that it cannot be put off indefinitely. A file larger than the whole budget is processed on its own.
+                while waiting and len(running) < self.workers:
+                    estimate = waiting[-1][0]
+                    if running and self.budget is not None and in_progress + estimate > self.budget:
+                        break
+                    estimate, order, filehelper = waiting.pop()
+                    running[executor.submit(process_worker_file, filehelper)] = (order, estimate)
+                    in_progress += estimate
+
+                if not running:
+                    break
+
+                done, pending = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    order, estimate = running.pop(future)
+                    in_progress -= estimate
+                    finished[order] = future.result()
+
+                while yielded in finished:
+                    yield finished.pop(yielded)
+                    yielded += 1
 
 
 class Genderiser(object):
+    # Names of casts made by all_casts which are longer than this are replaced by a checksum, so that they can be used as directory names
+    CAST_NAME_MAX = 100
 
     BUILTIN_CONFIG = """
 [main]
 # The regular expression to be used for variables. Must contain at least two groups: one for the character identifier and one for the word identifier. The default regular expression matches variables of the form surname_word:
 variable_regex = ([A-Za-z]+)_([A-Za-z]+)
+# The maximum size in megabytes of the cache of scanned documents kept in the .genderiser-cache directory in the project directory. Set to 0 to disable the cache.
+cache_size = 64
 
 [genders]
 # This section lists valid genders. Each key must be the name of a section in which a word list for a gender is defined. Values are optional and indicate a parent gender from which the gender inherits.
@@ -216,142 +1746,887 @@ theirs = eirs
 themselves = emself
 """
 
-    def __init__(self, project_dir=None):
+    def __init__(self, project_dir=None, cache=True, stats=None, config=None):
         self.cp = configparser.ConfigParser()
 
         self.subs = {}
         self.files = []
+        self.project_dir = project_dir
+        self.cache = None
+        self.stats = stats if stats is not None else NULL_STATS
+        # Where to print output; None for standard output
+        self.output = None
+
+        with self.stats.stage("config"):
+            # Read the default config
+            self.cp.read_file(io.StringIO(self.BUILTIN_CONFIG))
 
-        # Read the default config
-        self.cp.read_file(io.StringIO(self.BUILTIN_CONFIG))
+            # Read config files from the project directory
+            if project_dir is not None:
+                self.cp.read(glob.glob(os.path.join(project_dir, "*.cfg")))
 
-        # Read config files from the project directory
-        if project_dir is not None:
-            self.project_dir = project_dir
-            self.cp.read(glob.glob(os.path.join(project_dir, "*.cfg")))
+            # Config given directly, as a string in config file format or a dict of sections, goes after the project config
+            if isinstance(config, str):
+                self.cp.read_string(config)
+            elif config is not None:
+                self.cp.read_dict(config)
 
-        self.create_subs()
+            self.LISTSEP = re.compile(", *")
 
-        self.VARIABLE_REGEX = re.compile(self.cp.get("main", "variable_regex"))
-        self.LISTSEP = re.compile(", *")
+            self.update_subs()
 
-    def create_subs(self):
-        for surname, gender in self.cp.items("characters"):
-            # gender can inherit from other genders
-            # TODO: do this once for each gender, before processing the characters!
-            current_gender = gender
-            gender_dicts = []
+            self.VARIABLE_REGEX = re.compile(self.cp.get("main", "variable_regex"))
 
-            while current_gender:
-                if current_gender not in self.cp.options("genders"):
-                    raise GenderiserError("%r is not listed in the genders configuration section." % current_gender)
+        cache_size = self.cp.getfloat("main", "cache_size")
+        if cache and project_dir is not None and cache_size > 0:
+            self.cache = TemplateCache(project_dir, int(cache_size * 1024 * 1024))
 
-                if current_gender not in self.cp.sections():
-                    raise GenderiserError("No configuration section found for gender %r." % current_gender)
+    def characters(self):
+        if not self.cp.has_section("characters"):
+            return {}
+        return dict(self.cp.items("characters"))
 
-                gender_dicts.append(dict(self.cp.items(current_gender)))
-                current_gender = self.cp.get("genders", current_gender)
+    def resolve_gender(self, gender):
+        """The word list of a gender merged with those of the genders it inherits from. Each gender is only resolved once."""
+        chain = []
+        current_gender = gender
 
-            gender_dict = {}
-            for d in reversed(gender_dicts):
-                gender_dict.update(d)
+        # gender can inherit from other genders
+        while current_gender and current_gender not in self.resolved_genders:
+            if current_gender in chain:
+                raise GenderiserError("Gender %r inherits from itself: %s." % (current_gender, " -> ".join(chain + [current_gender])))
 
-            for key, value in gender_dict.items():
+            if not self.cp.has_option("genders", current_gender):
+                raise GenderiserError("%r is not listed in the genders configuration section." % current_gender)
+
+            if not self.cp.has_section(current_gender):
+                raise GenderiserError("No configuration section found for gender %r." % current_gender)
+
+            chain.append(current_gender)
+            current_gender = self.cp.get("genders", current_gender)
+
+        # Merge from the first already resolved ancestor down to the requested gender, resolving each step on the way
+        gender_dict = self.resolved_genders[current_gender] if current_gender else {}
+        for current_gender in reversed(chain):
+            gender_dict = dict(gender_dict)
+            gender_dict.update(self.cp.items(current_gender))
+            self.resolved_genders[current_gender] = gender_dict
+
+        return gender_dict
+
+    def character_subs(self, surname, gender):
+        if (surname, gender) not in self.resolved_characters:
+            subs = {}
+
+            for key, value in self.resolve_gender(gender).items():
                 if key.startswith("%s_" % surname): # special variable for this character
-                    self.subs[key] = value
+                    subs[key] = value
                 elif "_" in key: # special variable for a different character
                     continue
                 else: # generic word
-                    self.subs["%s_%s" % (surname, key)] = value
+                    subs["%s_%s" % (surname, key)] = value
 
-    def find_files(self):
-        if not self.project_dir:
-            raise GenderiserError("No project directory specified.")
+            self.resolved_characters[(surname, gender)] = subs
+
+        return self.resolved_characters[(surname, gender)]
+
+    def create_subs(self, characters=None):
+        if characters is None:
+            characters = self.characters()
+
+        subs = {}
+        for surname, gender in characters.items():
+            subs.update(self.character_subs(surname, gender))
+
+        return subs
+
+    def create_table(self, characters=None):
+        return SubstitutionTable(self.create_subs(characters))
+
+    def read_config(self, *paths):
+        """Read more config files, after the project config."""
+        read = self.cp.read(paths)
+        if len(read) != len(paths):
+            raise GenderiserError("Unable to read config file(s) %s." % ", ".join(sorted(set(paths) - set(read))))
+
+        self.update_subs()
+
+    def update_subs(self):
+        # Gender word lists may have changed, so they must be resolved again
+        self.resolved_genders = {}
+        self.resolved_characters = {}
+
+        self.table = self.create_table()
+        self.subs = self.table.subs
+        # Tables for other casts, kept for documents rendered in memory
+        self.tables = {}
+
+    def named_casts(self):
+        """Casts listed in the casts section. Each cast overrides the genders of some characters in the characters section."""
+        casts = []
+
+        if self.cp.has_section("casts"):
+            defaults = self.characters()
+
+            for name, value in self.cp.items("casts"):
+                characters = dict(defaults)
+
+                for pair in self.LISTSEP.split(value.strip()):
+                    if not pair:
+                        continue
+                    surname, sep, gender = pair.partition(":")
+                    surname = surname.strip().lower()
+                    if not sep or surname not in defaults:
+                        raise GenderiserError("Cast %r: %r is not of the form character:gender for a known character." % (name, pair))
+                    characters[surname] = gender.strip()
+
+                casts.append((name, characters))
+
+        if not casts:
+            raise GenderiserError("No casts found.")
+
+        return casts
 
-        if self.cp.has_section("files"):
-            if self.cp.has_option("files", "files"):
-                for filename in self.LISTSEP.split(self.cp.get("files", "files")):
-                    self.files.append(FileHelper.get_helper(os.path.join(self.project_dir, filename), self.project_dir))
+    def all_casts(self, genders=None):
+        """Every combination of the given genders for every character. By default the genders already used in the characters section are combined.
 
-            if self.cp.has_option("files", "glob"):
-                expanded = sorted(glob.glob(os.path.join(self.project_dir, self.cp.get("files", "glob"))))
-                for filepath in expanded:
-                    self.files.append(FileHelper.get_helper(filepath, self.project_dir))
+        Each cast is named after the characters whose genders differ from the characters section, e.g. smith-female.jones-male, or is named default if none do. The genders of every character are recorded in the manifest of each cast's output directory."""
+        defaults = self.characters()
+        surnames = list(defaults)
 
-        if not self.files:
+        if genders is None:
+            genders = []
+            for gender in defaults.values():
+                if gender not in genders:
+                    genders.append(gender)
+
+        for combination in itertools.product(genders, repeat=len(surnames)):
+            characters = dict(zip(surnames, combination))
+            name = ".".join("%s-%s" % (surname, gender) for surname, gender in characters.items() if gender != defaults[surname]) or "default"
+            if len(name) > self.CAST_NAME_MAX:
+                name = "cast-%s" % checksum(name)[:16]
+            yield name, characters
+
+    def file_patterns(self, option):
+        if not self.cp.has_option("files", option):
+            return []
+        return [path_pattern(pattern) for pattern in self.LISTSEP.split(self.cp.get("files", option).strip()) if pattern]
+
+    def find_paths(self, skip=()):
+        """The paths of the documents in the project, without opening them. Documents found by the include patterns are yielded as each directory is walked. Directories in skip, such as the output directory, are not walked."""
+        if not self.project_dir:
+            raise GenderiserError("No project directory specified.")
+
+        if not self.cp.has_section("files"):
+            return
+
+        exclude = self.file_patterns("exclude")
+        # The same document may be matched more than once, but is only rendered once
+        found = set()
+
+        def new(path):
+            if path in found:
+                return False
+            found.add(path)
+            return True
+
+        if self.cp.has_option("files", "files"):
+            for filename in self.LISTSEP.split(self.cp.get("files", "files")):
+                path = os.path.join(self.project_dir, filename)
+                if new(path):
+                    yield path
+
+        if self.cp.has_option("files", "glob"):
+            for path in sorted(glob.glob(os.path.join(self.project_dir, self.cp.get("files", "glob")))):
+                relpath = os.path.relpath(path, self.project_dir).replace(os.sep, "/")
+                if not any(regex.match(relpath) for regex in exclude) and new(path):
+                    yield path
+
+        include = self.file_patterns("include")
+        if include:
+            path = None
+            if self.cache is not None:
+                path = os.path.join(self.project_dir, TemplateCache.DIRNAME, DirectoryListings.FILENAME)
+            listings = DirectoryListings(path).load()
+
+            skip = set(os.path.relpath(os.path.abspath(skipdir), os.path.abspath(self.project_dir)).replace(os.sep, "/") for skipdir in skip)
+            for relpath, path in listings.walk(self.project_dir, exclude, skip):
+                # Config files in the project directory are never documents
+                if "/" not in relpath and relpath.endswith(".cfg"):
+                    continue
+                if any(regex.match(relpath) for regex in include) and new(path):
+                    yield path
+
+    def document_paths(self):
+        return list(self.find_paths())
+
+    def documents(self, filenames=None, skip=()):
+        """A helper for each document, or only for those whose names are in filenames, each created as it is needed."""
+        paths = self.find_paths(skip)
+        found = False
+
+        while True:
+            # The time taken to find and open each document is recorded, but not the time taken to process it
+            with self.stats.stage("find_files"):
+                path = next(paths, None)
+                while path is not None and filenames is not None and os.path.relpath(path, self.project_dir) not in filenames:
+                    path = next(paths, None)
+                if path is not None:
+                    try:
+                        filehelper = FileHelper.get_helper(path, self.project_dir)
+                    except (GenderiserError, EnvironmentError) as e:
+                        # The error is reported when the file is processed, along with those of any other files
+                        filehelper = UnreadableFileHelper(path, self.project_dir, e)
+
+            if path is None:
+                break
+            found = True
+            yield filehelper
+
+        if not found:
             raise GenderiserError("No files found.")
 
-    def replace(self, output_dir=None, preview=False):
-        self.find_files()
+    def find_files(self, filenames=None):
+        """Create a helper for each document, or only for those whose names are in filenames."""
+        self.files = list(self.documents(filenames))
+
+        for filehelper in self.files:
+            if isinstance(filehelper, UnreadableFileHelper):
+                raise filehelper.error
 
+    def replace(self, output_dir=None, preview=False, casts=None, jobs=1, force=False, text_mode="memory", filenames=None, dedup="link", memory_budget=None):
+        """Render the documents for each cast, or only those whose names are in filenames. With more than one job, files are processed in parallel within memory_budget bytes of estimated memory use."""
         if output_dir is None:
             output_dir = os.path.join(self.project_dir, "output")
-        elif os.path.samefile(self.project_dir, output_dir):
+        elif os.path.exists(output_dir) and os.path.samefile(self.project_dir, output_dir):
             raise GenderiserError("Output directory cannot be the same as input directory. You would overwrite your files!")
 
-        def var_sub(m):
-            surname, word = m.groups()
-            key = "%s_%s" % (surname.lower(), word.lower())
-            replacement = self.subs.get(key)
-            if replacement:
-                if surname == surname.capitalize():
-                    return replacement.capitalize()
-                return replacement
+        # Each cast is rendered into its own subdirectory of the output directory
+        if casts is None:
+            renders = [Render(None, self.characters(), self.table, output_dir)]
+        else:
+            renders = [Render(name, characters, self.create_table(characters), os.path.join(output_dir, name)) for name, characters in casts]
+
+        if not preview:
+            for render in renders:
+                render.manifest.load()
+
+        if jobs is None or jobs < 1:
+            jobs = os.cpu_count() or 1
+
+        job = Job(self.VARIABLE_REGEX, renders, preview, force, self.cache, text_mode, self.stats.enabled, dedup)
+
+        # Documents are found as they are processed; the output directory is not searched for them
+        files = self.documents(filenames, [output_dir])
+        first = list(itertools.islice(files, 2))
+
+        if jobs == 1 or len(first) < 2:
+            # Each file is closed by process_file once it has been rendered
+            results = map(process_file, itertools.chain(first, files), itertools.repeat(job))
+            return self.report(renders, results, preview, filenames is not None)
+        else:
+            results = Scheduler(jobs, memory_budget).run(itertools.chain(first, files), job)
+            return self.report(renders, results, preview, filenames is not None)
+
+    def output_dir(self, output_dir=None):
+        return os.path.join(self.project_dir, "output") if output_dir is None else output_dir
+
+    def remove_outputs(self, filenames, output_dir=None, casts=None):
+        """Remove the outputs of documents which no longer exist, and their entries in the manifest, for each cast. Only outputs listed in a manifest are removed. Returns the Report of what was removed."""
+        output_dir = self.output_dir(output_dir)
+        report = Report()
+
+        for name, characters in [(None, None)] if casts is None else casts:
+            render_dir = output_dir if name is None else os.path.join(output_dir, name)
+            manifest = Manifest(render_dir).load()
+            removed = [filename for filename in sorted(filenames) if filename in manifest.entries]
+            if not removed:
+                continue
+
+            for filename in removed:
+                try:
+                    os.remove(os.path.join(render_dir, filename))
+                except FileNotFoundError:
+                    pass
+                del manifest.entries[filename]
+                report.removed.append(filename if name is None else "%s/%s" % (name, filename))
+            manifest.save(manifest.entries, manifest.characters, manifest.genders)
+
+        return report
+
+    def render_shard(self, shard, output_dir=None, casts=None, jobs=1, force=False, text_mode="memory", dedup="link", memory_budget=None):
+        """Render this shard's slice of the casts, and record that it has finished."""
+        if casts is None:
+            raise GenderiserError("Only casts can be sharded. Use --casts or --all-casts.")
+
+        output_dir = self.output_dir(output_dir)
+        casts = shard.casts(casts)
+        report = self.replace(output_dir, False, casts, jobs, force, text_mode, dedup=dedup, memory_budget=memory_budget)
+        shard.save(output_dir, casts, report)
+        return report
+
+    def merge_shards(self, count, output_dir=None, casts=None):
+        """Check that every file has been rendered for every cast by count shards, and combine the shards' reports. Raises an error listing what is missing if the render is incomplete."""
+        if casts is None:
+            raise GenderiserError("Only casts can be sharded. Use --casts or --all-casts.")
+
+        output_dir = self.output_dir(output_dir)
+        report = Report()
+        problems = []
+
+        for index in range(1, count + 1):
+            shard = Shard(index, count)
+            record = shard.load(output_dir)
+            if record is None:
+                problems.append("Shard %d/%d has not finished" % (index, count))
             else:
-                return "UNKNOWN"
+                report.merge(record[1])
 
-        for filehelper in self.files:
-            # Read content
-            filehelper.read()
+        # Whatever the records say, the render is only complete if every output is current
+        input_checksums = {}
+        for filehelper in self.documents(skip=[output_dir]):
+            with filehelper:
+                input_checksums[filehelper.filename] = filehelper.checksum()
+        regex_checksum = checksum(self.VARIABLE_REGEX.pattern)
+
+        for name, characters in casts:
+            render = Render(name, characters, self.create_table(characters), os.path.join(output_dir, name))
+            render.manifest.load()
+            for filename, input_checksum in input_checksums.items():
+                if not render.manifest.is_current(filename, input_checksum, regex_checksum, render.checksums):
+                    problems.append("Missing or out of date output %s" % render.title(filename))
+
+        if problems:
+            raise GenderiserError("Sharded render is incomplete:\n%s" % "\n".join(problems))
 
-            # Replace variables
-            filehelper.text = self.VARIABLE_REGEX.sub(var_sub, filehelper.text)
+        return report
 
+    def report(self, renders, results, preview, partial=False):
+        report = Report()
+        # If only some files were processed, the others keep their entries
+        entries = [dict(render.manifest.entries) if partial else {} for render in renders]
+
+        for result in results:
             # Print a preview to stdout
-            if preview:
-                print("%s:" % filehelper.filename)
-                print("-" * (len(filehelper.filename) + 1))
-                print(filehelper.plain_text().strip())
-                print("")
+            for text in result.previews:
+                print(text, file=self.output)
 
-            # Otherwise try to write to a file
-            elif output_dir is not None:
-                filehelper.write(output_dir)
+            if self.stats.enabled:
+                self.stats.records.extend(result.stats)
+
+            for i in result.skipped:
+                entry = renders[i].manifest.entries[result.filename]
+                entries[i][result.filename] = entry
+                report.skipped.append(renders[i].title(result.filename))
+                report.add_usage(renders[i], result.filename, Usage(entry["counts"], entry["unknown"]))
+
+            for i, usage in result.usage:
+                report.add_usage(renders[i], result.filename, usage)
+
+            for i, saved_bytes in result.deduplicated:
+                report.deduplicated.append(renders[i].title(result.filename))
+                report.saved_bytes += saved_bytes
+
+            for i, entry in result.rendered:
+                entries[i][result.filename] = entry
+                report.written.append(renders[i].title(result.filename))
+
+            if result.error is not None:
+                report.errors.append(result.error)
+
+        # Files which failed are left out of the manifest, so that they are rendered again next time
+        if not preview:
+            changed = set()
+            for render, render_entries in zip(renders, entries):
+                changed.update(render.manifest.changed_characters(render.checksums))
+                render.manifest.save(render_entries, render.checksums, render.characters)
+            report.changed_characters = sorted(changed)
+
+        if self.cache is not None:
+            self.cache.evict()
+
+        if report.errors:
+            raise GenderiserError("Unable to process %d file(s):\n%s" % (len(report.errors), "\n".join(report.errors)))
+
+        return report
+
+    def render(self, document, characters=None):
+        """Render a document held in memory, without reading or writing any files. The document can be bytes or a binary file object, and the rendered document is returned as bytes. characters optionally maps character identifiers to genders, overriding the characters section."""
+        if characters is None:
+            table = self.table
+        else:
+            key = frozenset(characters.items())
+            if key not in self.tables:
+                self.tables[key] = self.create_table(dict(self.characters(), **characters))
+            table = self.tables[key]
+
+        if not isinstance(document, bytes):
+            document = document.read()
+
+        with FileHelper.from_file(io.BytesIO(document)) as filehelper:
+            filehelper.read()
+            filehelper.text = filehelper.tokenize(self.VARIABLE_REGEX).render(table)
+            outfile = io.BytesIO()
+            filehelper.write_to(outfile)
+
+        return outfile.getvalue()
 
     def substitutions(self):
-        print(",".join("%s:%s" % (k, v) for (k, v) in sorted(self.subs.items())))
+        print(",".join("%s:%s" % (k, v) for (k, v) in sorted(self.subs.items())), file=self.output)
+
+    def update_index(self):
+
+        # The index is kept with the template cache, or only in memory if the cache is disabled
+        path = None
+        if self.cache is not None:
+            path = os.path.join(self.project_dir, TemplateCache.DIRNAME, VariableIndex.FILENAME)
+
+        index = VariableIndex(path).load()
+        with self.stats.stage("index"):
+            index.update(self.documents(), self.VARIABLE_REGEX, self.cache, self.stats)
+
+        if self.cache is not None:
+            self.cache.evict()
+
+        return index
 
     def missing(self):
-        self.find_files()
+        index = self.update_index()
         variables_used = set()
 
-        for filehelper in self.files:
-            filehelper.read()
-            for surname, word in self.VARIABLE_REGEX.findall(filehelper.plain_text()):
-                variables_used.add(("%s_%s" % (surname, word)).lower())
+        for filename, part, offset, line, surname, word in index.occurrences():
+            variables_used.add(("%s_%s" % (surname, word)).lower())
     
         missing_variables = variables_used - set(self.subs) - set(s.capitalize() for s in self.subs)
     
-        print(",".join(m for m in sorted(missing_variables)))
+        print(",".join(m for m in sorted(missing_variables)), file=self.output)
+
+    def where(self, name):
+        """Print the location of every use of a variable, or of any variable for a character."""
+        index = self.update_index()
+        name = name.lower()
+
+        for filename, part, offset, line, surname, word in index.occurrences():
+            variable = "%s_%s" % (surname, word)
+            if name in (variable.lower(), surname.lower()):
+                print("%s:%d:%d: %s" % (location(filename, part), line, offset, variable), file=self.output)
 
     @classmethod
     def create_from(cls, args):
-        return cls(args.project_dir)
+        stats = Stats() if args.stats else None
+        gen = cls(args.project_dir, cache=not args.no_cache, stats=stats)
+
+        if args.casts_file:
+            gen.read_config(args.casts_file)
+
+        return gen
+
+    def casts_from(self, args):
+        if args.all_casts:
+            genders = self.LISTSEP.split(args.cast_genders) if args.cast_genders else None
+            # Every combination is only generated as it is rendered, so that a shard of a large render does not need them all
+            return self.all_casts(genders)
+        elif args.casts or args.casts_file:
+            return self.named_casts()
+        else:
+            return None
+
+    def budget_from(self, args):
+        """The memory budget given in megabytes on the command line, in bytes."""
+        return None if args.memory_budget is None else int(args.memory_budget * 1024 * 1024)
 
     def process(self, args):
-        if args.substitutions:
+        unknown = []
+
+        if args.serve:
+            serve(args.serve, self)
+
+        elif args.substitutions:
             self.substitutions()
 
+        elif args.where:
+            self.where(args.where)
+
         else:
             if args.missing:
                 self.missing()
 
+            elif args.watch:
+                Watcher(self, args).run()
+
+            else:
+                if args.merge_shards:
+                    report = self.merge_shards(args.merge_shards, args.output_dir, self.casts_from(args))
+                elif args.shard:
+                    report = self.render_shard(Shard.parse(args.shard), args.output_dir, self.casts_from(args), args.jobs, args.force, args.text_mode, args.dedup, self.budget_from(args))
+                else:
+                    output_dir = args.output_dir if not args.preview else None
+                    report = self.replace(output_dir, args.preview, self.casts_from(args), args.jobs, args.force, args.text_mode, dedup=args.dedup, memory_budget=self.budget_from(args))
+
+                # What happened in each shard has already been printed by the shard
+                if not args.merge_shards:
+                    if report.changed_characters:
+                        print("Characters changed since the last run: %s" % ", ".join(report.changed_characters), file=self.output)
+
+                    for title in report.skipped:
+                        print("Skipped unchanged file %s" % title, file=self.output)
+
+                    if report.deduplicated:
+                        print("Reused %d identical output(s), saving %d bytes" % (len(report.deduplicated), report.saved_bytes), file=self.output)
+
+                    for title, part, offset, line, variable in report.unknown:
+                        sys.stderr.write("%s:%d:%d: Unknown variable %s\n" % (location(title, part), line, offset, variable))
+
+                if args.report_file:
+                    with open(args.report_file, "w") as f:
+                        report.dump(f)
+
+                unknown = report.unknown
+
+        if args.stats:
+            if args.stats_file:
+                with open(args.stats_file, "w") as f:
+                    self.stats.dump(f, args.stats_format)
+            else:
+                self.stats.dump(sys.stderr, args.stats_format)
+
+        if args.strict and unknown:
+            raise GenderiserError("%d unknown variable(s) used." % len(unknown))
+
+
+class Watcher(object):
+    """Renders a project, then renders it again whenever its documents or config files change, until interrupted. Only documents which have changed, or which use substitutions which have changed, are rendered again."""
+    INTERVAL = 0.5
+    # Changes are only acted on once the files have stopped changing for this long, so that a burst of saves is rendered once
+    DEBOUNCE = 0.3
+
+    def __init__(self, gen, args):
+        self.gen = gen
+        self.args = args
+        self.snapshot = self.files()
+        # The documents when the snapshot was last acted on, to tell deleted documents from config files
+        self.documents = set(self.gen.document_paths())
+
+    def config_paths(self):
+        paths = glob.glob(os.path.join(self.gen.project_dir, "*.cfg"))
+        if self.args.casts_file:
+            paths.append(self.args.casts_file)
+        return paths
+
+    def files(self):
+        """The size and modification time of each document and config file."""
+        snapshot = {}
+        for path in self.gen.document_paths() + self.config_paths():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def changes(self):
+        """Wait for files to change, and return the paths of those which have."""
+        while True:
+            time.sleep(self.INTERVAL)
+            snapshot = self.files()
+            if snapshot == self.snapshot:
+                continue
+
+            while True:
+                time.sleep(self.DEBOUNCE)
+                later = self.files()
+                if later == snapshot:
+                    break
+                snapshot = later
+
+            changed = set(path for path in set(snapshot) | set(self.snapshot) if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            return changed
+
+    def cast_subs(self, gen):
+        casts = gen.casts_from(self.args)
+        if casts is None:
+            return {None: gen.subs}
+        return dict((name, gen.create_subs(characters)) for name, characters in casts)
+
+    def update(self, paths):
+        """Render the documents affected by changes to these paths, and remove the outputs of documents which have been deleted. Returns the Report, or None if there was nothing to do."""
+        args = self.args
+        documents = set(self.gen.document_paths())
+        filenames = set(os.path.relpath(path, self.gen.project_dir) for path in paths if path in documents and os.path.exists(path))
+        deleted = set(path for path in paths if path in self.documents | documents and not os.path.exists(path))
+
+        removed = None
+        if deleted:
+            removed = self.gen.remove_outputs([os.path.relpath(path, self.gen.project_dir) for path in deleted], args.output_dir, self.gen.casts_from(args))
+
+        if set(paths) - documents - deleted:
+            # The config has changed: find the substitutions which are different in any cast
+            old_pattern = self.gen.VARIABLE_REGEX.pattern
+            old_subs = self.cast_subs(self.gen)
+            self.gen = Genderiser.create_from(self.args)
+            new_subs = self.cast_subs(self.gen)
+
+            if self.gen.VARIABLE_REGEX.pattern != old_pattern or set(new_subs) - set(old_subs):
+                # A new regex may find different variables in any document, and a new cast needs every document. Outputs which are still current are skipped by the manifests.
+                filenames = None
+            else:
+                changed_keys = set()
+                for name in set(old_subs) | set(new_subs):
+                    old, new = old_subs.get(name, {}), new_subs.get(name, {})
+                    changed_keys.update(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+                # Render the documents which use any of them, and any documents new to the config
+                index = self.gen.update_index()
+                for filename, part, offset, line, surname, word in index.occurrences():
+                    if SubstitutionTable.key(surname, word)[0] in changed_keys:
+                        filenames.add(filename)
+                filenames.update(os.path.relpath(path, self.gen.project_dir) for path in set(self.gen.document_paths()) - documents)
+
+        self.documents = set(self.gen.document_paths())
+
+        if filenames is not None and not filenames:
+            return removed
+
+        report = self.gen.replace(args.output_dir, False, self.gen.casts_from(args), args.jobs, args.force, args.text_mode, filenames, args.dedup, self.gen.budget_from(args))
+        if removed is not None:
+            report.merge(removed)
+        return report
+
+    def print_report(self, report):
+        for title in report.written:
+            print("Rendered %s" % title, file=self.gen.output)
+        for title in report.removed:
+            print("Removed %s" % title, file=self.gen.output)
+        for title, part, offset, line, variable in report.unknown:
+            sys.stderr.write("%s:%d:%d: Unknown variable %s\n" % (location(title, part), line, offset, variable))
+
+    def run(self):
+        args = self.args
+        self.print_report(self.gen.replace(args.output_dir, False, self.gen.casts_from(args), args.jobs, args.force, args.text_mode, dedup=args.dedup, memory_budget=self.gen.budget_from(args)))
+        sys.stderr.write("Watching %s for changes. Press Ctrl-C to stop.\n" % self.gen.project_dir)
+
+        try:
+            while True:
+                paths = self.changes()
+                try:
+                    report = self.update(paths)
+                except GenderiserError as e:
+                    # Keep watching, so that the mistake can be fixed
+                    sys.stderr.write("%s\n" % e)
+                    continue
+                if report is not None:
+                    self.print_report(report)
+        except KeyboardInterrupt:
+            pass
+
+
+def config_signature(project_dir):
+    """The size and modification time of each config file in a project, to notice when the config has changed."""
+    paths = sorted(glob.glob(os.path.join(project_dir, "*.cfg")))
+    return [(path, os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths]
+
+
+class ServedProject(object):
+    """A project kept ready between requests to the server. Requests for the same project are handled one at a time."""
+
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.signature = None
+        self.gen = None
+
+
+class ProjectPool(object):
+    """Genderisers for each project directory, kept between requests and created again when a project's config files change."""
+
+    def __init__(self, cache=True):
+        self.cache = cache
+        self.projects = {}
+        import threading
+        self.lock = threading.Lock()
+
+    def add(self, gen):
+        project = ServedProject()
+        project.signature = config_signature(gen.project_dir)
+        project.gen = gen
+        self.projects[os.path.abspath(gen.project_dir)] = project
+
+    @contextlib.contextmanager
+    def get(self, project_dir):
+        if not os.path.isdir(project_dir):
+            raise GenderiserError("No project directory %r." % project_dir)
+
+        with self.lock:
+            project = self.projects.setdefault(os.path.abspath(project_dir), ServedProject())
+
+        with project.lock:
+            signature = config_signature(project_dir)
+            if project.gen is None or project.signature != signature:
+                project.gen = Genderiser(project_dir, cache=self.cache)
+                project.signature = signature
+            yield project.gen
+
+
+class Metrics(object):
+    """The latency of recent requests to each endpoint of the server."""
+    RECENT = 1000
+
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.errors = {}
+        self.latencies = {}
+
+    def record(self, endpoint, seconds, error=False):
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + int(error)
+            self.latencies.setdefault(endpoint, collections.deque(maxlen=self.RECENT)).append(seconds)
+
+    def summary(self):
+        summary = {}
+
+        with self.lock:
+            for endpoint, latencies in self.latencies.items():
+                latencies = sorted(latencies)
+                summary[endpoint] = {
+                    "count": self.counts[endpoint],
+                    "errors": self.errors[endpoint],
+                    "mean": sum(latencies) / len(latencies),
+                    "p50": latencies[len(latencies) // 2],
+                    "p95": latencies[min(len(latencies) - 1, len(latencies) * 95 // 100)],
+                    "max": latencies[-1],
+                }
+
+        return summary
+
+
+class RenderService(object):
+    """Handles render, preview and missing requests for a project, in-memory document renders, and metrics, for the server run by --serve. The project parameter names a project directory inside the server's project directory (by default the server's project itself), and cast parameters name casts.
+
+    The HTTP side of the server is in genderiser_server, so that http.server, which is slow to import, is only imported when serving."""
+
+    def __init__(self, project_dir, cache=True):
+        self.project_dir = project_dir
+        self.pool = ProjectPool(cache)
+        self.metrics = Metrics()
+
+    def respond(self, path, body=b""):
+        """The status, content type and body of the response to a request for path, which may include a query string."""
+        import urllib.parse
+
+        url = urllib.parse.urlsplit(path)
+        endpoint = url.path.strip("/")
+        params = urllib.parse.parse_qs(url.query)
+        handler = getattr(self, "handle_%s" % endpoint, None)
+        start = time.perf_counter()
+        status = 200
+
+        try:
+            if handler is None:
+                status, content_type, body = 404, "text/plain", b"Unknown request.\n"
             else:
-                output_dir = args.output_dir if not args.preview else None
-                self.replace(output_dir, args.preview)
+                content_type, body = handler(params, body)
+        except GenderiserError as e:
+            status, content_type, body = 400, "text/plain", ("%s\n" % e).encode("utf-8")
+        except Exception as e:
+            status, content_type, body = 500, "text/plain", ("%s: %s\n" % (e.__class__.__name__, e)).encode("utf-8")
+
+        if handler is not None and endpoint != "metrics":
+            self.metrics.record(endpoint, time.perf_counter() - start, status != 200)
+
+        return status, content_type, body
+
+    def project(self, params):
+        if "project" not in params:
+            return self.pool.get(self.project_dir)
+
+        # Requests can only read projects inside the server's project directory
+        root = os.path.realpath(self.project_dir)
+        project_dir = os.path.realpath(os.path.join(root, params["project"][0]))
+        if os.path.commonpath([root, project_dir]) != root:
+            raise GenderiserError("Project %r is not inside %s." % (params["project"][0], self.project_dir))
+        return self.pool.get(project_dir)
+
+    def casts(self, gen, params):
+        names = params.get("cast")
+        if not names:
+            return None
+
+        casts = dict(gen.named_casts())
+        for name in names:
+            if name not in casts:
+                raise GenderiserError("Unknown cast %r." % name)
+        return [(name, casts[name]) for name in names]
+
+    def output(self, gen, function, *args):
+        gen.output = io.StringIO()
+        try:
+            function(*args)
+            return "text/plain", gen.output.getvalue().encode("utf-8")
+        finally:
+            gen.output = None
+
+    def handle_render(self, params, body):
+        # Output always goes to the project's own output directory
+        with self.project(params) as gen:
+            report = gen.replace(casts=self.casts(gen, params), force="force" in params)
+        outfile = io.StringIO()
+        report.dump(outfile)
+        return "application/json", outfile.getvalue().encode("utf-8")
+
+    def handle_preview(self, params, body):
+        with self.project(params) as gen:
+            return self.output(gen, gen.replace, None, True, self.casts(gen, params))
+
+    def handle_missing(self, params, body):
+        with self.project(params) as gen:
+            return self.output(gen, gen.missing)
+
+    def handle_document(self, params, body):
+        with self.project(params) as gen:
+            casts = self.casts(gen, params)
+            characters = casts[0][1] if casts else None
+            return "application/octet-stream", gen.render(body, characters)
+
+    def handle_metrics(self, params, body):
+        return "application/json", json.dumps(self.metrics.summary(), indent=1, sort_keys=True).encode("utf-8")
+
+
+def serve(address, gen):
+    """Serve requests until interrupted. address is a port, or host:port; the host defaults to localhost. The server has no authentication, so only loopback addresses are allowed."""
+    import ipaddress
+    import socket
+    from genderiser_server import RenderServer
+
+    host, sep, port = address.rpartition(":")
+    host = host or "127.0.0.1"
+    try:
+        port = int(port)
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+    except (ValueError, OSError) as e:
+        raise GenderiserError("Unable to serve on %r: %s" % (address, e))
+    if not all(ipaddress.ip_address(a).is_loopback for a in addresses):
+        raise GenderiserError("The server has no authentication, so it can only serve on a loopback address such as 127.0.0.1, not %s." % host)
+
+    service = RenderService(gen.project_dir, gen.cache is not None)
+    service.pool.add(gen)
+    server = RenderServer((host, port), service)
+
+    sys.stderr.write("Serving on http://%s:%d/\n" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 def main(args=None):
+    import argparse
+
     parser = argparse.ArgumentParser(description="Replace placeholder variables with gendered words in text files")
     
     parser.add_argument("project_dir", help="Project directory to process")
@@ -362,6 +2637,30 @@ def main(args=None):
     action.add_argument("-s", "--substitutions", help="Suppress all other output and print a list of substitutions.", action="store_true")
     action.add_argument("-p", "--preview", help="Suppress all other output and print the modified file contents to standard output.", action="store_true")
     action.add_argument("-m", "--missing", help="Suppress all other output and print a list of variables for which no replacements could be found.", action="store_true")
+    action.add_argument("--serve", help="Run a local HTTP server on this port, or host:port, which keeps projects ready between requests. Requests are /render, /preview, /missing and /document (a document in the request body, rendered in memory), with optional project (a directory inside project_dir) and cast parameters, and /metrics for request latencies. Only loopback hosts are allowed, as there is no authentication.", metavar="[HOST:]PORT")
+    action.add_argument("--watch", help="Render the project, then keep rendering the documents affected by each change to the documents or config files, until interrupted.", action="store_true")
+    action.add_argument("--merge-shards", help="Check that a render split into this many shards with --shard is complete, and combine the shards' reports for --report-file and --strict.", type=int, metavar="COUNT")
+    action.add_argument("-w", "--where", help="Suppress all other output and print the file, line and offset of every use of this variable, or of any variable for this character.")
+
+    parser.add_argument("--strict", help="Fail if any variable could not be replaced.", action="store_true")
+    parser.add_argument("--report-file", help="Write a JSON report of the files written and skipped, the number of variables replaced for each character, and the location of any unknown variables to this file.")
+    parser.add_argument("-f", "--force", help="Render every file, even if its input and substitutions have not changed since the last run.", action="store_true")
+    parser.add_argument("--no-cache", help="Do not read or update the cache of scanned documents.", action="store_true")
+    parser.add_argument("--text-mode", help="How to process plain text files and the content of documents. 'memory' reads each file into memory once for all casts. 'stream' substitutes and writes each file (or document content) a chunk at a time, so that memory use does not depend on the size of the file. 'mmap' maps plain text files into memory and writes them out around the substitutions without decoding them, which is fastest for large files in ASCII compatible encodings; other documents are processed as in 'memory'.", choices=("memory", "stream", "mmap"), default="memory")
+    parser.add_argument("--dedup", help="What to do when a file is rendered the same for several casts. 'link' writes it once and hard links it into the other casts' output directories (copying it if links are not supported), 'copy' writes it once and copies it, and 'none' renders it again for each cast.", choices=("link", "copy", "none"), default="link")
+    parser.add_argument("--stats", help="Print the time, bytes, variable matches and peak memory of each stage of processing each file to standard error.", action="store_true")
+    parser.add_argument("--stats-format", help="Print the stats as a table or as JSON.", choices=("table", "json"), default="table")
+    parser.add_argument("--stats-file", help="Write the stats to this file instead of standard error.")
+    parser.add_argument("--shard", help="Only render this slice of the casts, given as index/count (e.g. 2/8), so that a large render can be split between machines sharing the output directory. Use --merge-shards to check that all shards have finished.", metavar="INDEX/COUNT")
+    parser.add_argument("-j", "--jobs", help="Number of files to process in parallel. Use 0 for one per CPU.", type=int, default=1)
+    parser.add_argument("--memory-budget", help="With more than one job, only start processing a file if the estimated memory use of the files in progress would stay within this many megabytes. The largest files are processed first. A file larger than the budget is processed on its own.", type=float, metavar="MB")
+
+    casts = parser.add_mutually_exclusive_group(required=False)
+
+    casts.add_argument("-c", "--casts", help="Render every cast listed in the casts section of the config, each into its own subdirectory of the output directory.", action="store_true")
+    parser.add_argument("--casts-file", help="Read additional casts from this config file. Implies --casts.")
+    casts.add_argument("-a", "--all-casts", help="Render every combination of genders for all characters, each into its own subdirectory of the output directory.", action="store_true")
+    parser.add_argument("--cast-genders", help="Comma-separated list of genders to combine with --all-casts. By default the genders used in the characters section are combined.")
 
     args = parser.parse_args(args)
 
@@ -0,0 +1,31 @@
+"""The HTTP server run by genderiser --serve. It is kept apart from genderiser.py, which imports it only when serving, because http.server is slow to import. Requests are answered by a genderiser.RenderService."""
+import http.server
+
+
+class RenderRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Passes each request, with its body, to the server's RenderService."""
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def respond(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status, content_type, body = self.server.service.respond(self.path, body)
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RenderServer(http.server.ThreadingHTTPServer):
+    """A local HTTP server for a RenderService, which keeps projects ready between requests, so that config files are only read and documents only scanned again when they change."""
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        super(RenderServer, self).__init__(address, RenderRequestHandler)
+        self.service = service
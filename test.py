@@ -7,7 +7,18 @@ import tempfile
 import shutil
 import errno
 import os
-from genderiser import Genderiser, main, GenderiserError, FileHelper
+import zipfile
+import json
+import argparse
+import threading
+import urllib.request
+import urllib.error
+import time
+import concurrent.futures
+import subprocess
+from unittest import mock
+from genderiser import Genderiser, main, GenderiserError, FileHelper, TextFileHelper, TemplateCache, Template, SubstitutionTable, stream_sub, xml_tokens, RenderService, Watcher, serve, Scheduler, FileResult, Job, Stats
+from genderiser_server import RenderServer
 
 class TestGenderiser(unittest.TestCase):
     def setUp(self):
@@ -21,7 +32,7 @@ class TestGenderiser(unittest.TestCase):
         return out
 
     def test_preview(self):        
-        main(["-p", "example"])
+        main(["--no-cache", "-p", "example"])
         expected_preview = """Alice.txt:
 ----------
 You know a man called John Smith. He has a sister called Mary Jones.
@@ -38,19 +49,19 @@ You know a man called John Smith. He has a sister called Mary Jones.
         self.assertEqual(self.last_out(), expected_preview)
 
     def test_nothing_missing(self):
-        main(["-m", "example"])
+        main(["--no-cache", "-m", "example"])
         self.assertEqual(self.last_out(), "\n")
 
     def test_bad_output_dir(self):
         with self.assertRaises(GenderiserError):
-            main(["-o", "example", "example"])
+            main(["--no-cache", "-o", "example", "example"])
 
     def test_subs(self):
-        main(["-s", "example"])
+        main(["--no-cache", "-s", "example"])
         self.assertEqual(self.last_out(), "jones_child:daughter,jones_grandparent:grandmother,jones_name:Mary,jones_parent:mother,jones_parentsibling:aunt,jones_person:woman,jones_sibling:sister,jones_siblingchild:niece,jones_spouse:wife,jones_their:her,jones_theirs:hers,jones_them:her,jones_themselves:herself,jones_they:she,jones_youngperson:girl,smith_child:son,smith_grandparent:grandfather,smith_name:John,smith_parent:father,smith_parentsibling:uncle,smith_person:man,smith_sibling:brother,smith_siblingchild:nephew,smith_spouse:husband,smith_their:his,smith_theirs:his,smith_them:him,smith_themselves:himself,smith_they:he,smith_youngperson:boy\n")
 
     def test_missing_subs(self):
-        main(["-m", "test_data/missingsubs"])
+        main(["--no-cache", "-m", "test_data/missingsubs"])
         self.assertEqual(self.last_out(), "jones_name,smith_name,smith_person,smith_they\n")
 
     def test_bad_document_type(self):
@@ -58,7 +69,7 @@ You know a man called John Smith. He has a sister called Mary Jones.
             FileHelper.get_helper("test_data/Alice.doc", "somedir")
 
     def test_gender_inheritance(self):
-        main(["-p", "test_data/spivak"])
+        main(["--no-cache", "-p", "test_data/spivak"])
 
         expected_preview = """Alice.txt:
 ----------
@@ -69,7 +80,7 @@ You know a man called John Smith. He has a sister called Mary Jones.  Yesterday
         self.assertEqual(self.last_out(), expected_preview)
 
     def test_glob(self):        
-        main(["-p", "test_data/glob"])
+        main(["--no-cache", "-p", "test_data/glob"])
         expected_preview = """Alice.txt:
 ----------
 You know a man called John Smith. He has a sister called Mary Jones.
@@ -82,7 +93,7 @@ You know a man called John Smith. He has a sister called Mary Jones.
         self.assertEqual(self.last_out(), expected_preview)
 
     def test_subdir(self):        
-        main(["-p", "test_data/subdir"])
+        main(["--no-cache", "-p", "test_data/subdir"])
         expected_preview = """One/Alice.txt:
 --------------
 You know a man called John Smith. He has a sister called Mary Jones.
@@ -94,5 +105,781 @@ You know a man called John Smith. He has a sister called Mary Jones.
 """
         self.assertEqual(self.last_out(), expected_preview)
 
+    def test_include_exclude(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            project_dir = shutil.copytree("test_data/subdir", os.path.join(project_dir, "subdir"))
+            with open(os.path.join(project_dir, "subdir.cfg")) as f:
+                config = f.read()
+            with open(os.path.join(project_dir, "subdir.cfg"), "w") as f:
+                f.write(config.replace("files=One/Alice.txt, Two/Bob.txt", "include=**/*.txt\nexclude=media, **/draft-*"))
+            for filename in ("One/Deeper/Carol.txt", "One/draft-Dave.txt", "media/Eve.txt", ".hidden/Frank.txt", "Two/notes.md"):
+                os.makedirs(os.path.dirname(os.path.join(project_dir, filename)), exist_ok=True)
+                with open(os.path.join(project_dir, filename), "w") as f:
+                    f.write("Smith_they is here.\n")
+
+            found = ["One/Alice.txt", "One/Deeper/Carol.txt", "Two/Bob.txt"]
+            gen = Genderiser(project_dir)
+            self.assertEqual([os.path.relpath(path, project_dir) for path in gen.document_paths()], found)
+
+            # Outputs are not found as documents, even if they match
+            main([project_dir])
+            main([project_dir])
+            self.assertEqual(self.last_out(), "".join("Skipped unchanged file %s\n" % filename for filename in found))
+
+            # Directories which have not changed are not listed again
+            for dirpath, dirnames, filenames in os.walk(project_dir):
+                os.utime(dirpath, (0, 0))
+            gen.document_paths()
+            gen = Genderiser(project_dir)
+            with mock.patch("os.scandir", side_effect=AssertionError("Directory was listed")):
+                self.assertEqual([os.path.relpath(path, project_dir) for path in gen.document_paths()], found)
+
+            with open(os.path.join(project_dir, "Two", "Grace.txt"), "w") as f:
+                f.write("Smith_they is here.\n")
+            self.assertEqual([os.path.relpath(path, project_dir) for path in Genderiser(project_dir).document_paths()], found + ["Two/Grace.txt"])
+        finally:
+            shutil.rmtree(os.path.dirname(project_dir))
+
+    def test_casts(self):
+        main(["--no-cache", "-c", "-p", "test_data/casts"])
+        expected_preview = """default/Alice.txt:
+------------------
+You know a man called John Smith. He has a sister called Mary Jones.
+
+swapped/Alice.txt:
+------------------
+You know a woman called Jane Smith. She has a brother called Mark Jones.
+
+"""
+        self.assertEqual(self.last_out(), expected_preview)
+
+    def test_casts_file(self):
+        main(["--no-cache", "--casts-file", "test_data/casts/extra.casts", "-p", "test_data/casts"])
+        self.assertIn("""spivak/Alice.txt:
+-----------------
+You know a person called Jay Smith. E has a sister called Mary Jones.
+""", self.last_out())
+
+    def test_all_casts(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            main(["--no-cache", "-a", "-o", output_dir, "test_data/casts"])
+            self.assertEqual(sorted(os.listdir(output_dir)), ["default", "jones-male", "smith-female", "smith-female.jones-male"])
+
+            with open(os.path.join(output_dir, "smith-female.jones-male", "Alice.txt")) as f:
+                self.assertEqual(f.read(), "You know a woman called Jane Smith. She has a brother called Mark Jones.\n")
+            # The manifest records the genders of the cast
+            with open(os.path.join(output_dir, "smith-female.jones-male", ".genderiser-manifest.json")) as f:
+                self.assertEqual(json.load(f)["genders"], {"smith": "female", "jones": "male"})
+
+            # Names which would be too long for a directory are replaced by a checksum
+            gen = Genderiser(config={"characters": dict(("character%d" % i, "male") for i in range(20)), "female": {}})
+            names = [name for name, characters in gen.all_casts(["female"])]
+            self.assertEqual(len(names), 1)
+            self.assertRegex(names[0], "^cast-[0-9a-f]{16}$")
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_dedup(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            project_dir = shutil.copytree("test_data/casts", os.path.join(project_dir, "casts"))
+            with open(os.path.join(project_dir, "casts.cfg")) as f:
+                config = f.read()
+            with open(os.path.join(project_dir, "casts.cfg"), "w") as f:
+                f.write(config.replace("files=Alice.txt", "files=Alice.txt, Carol.txt"))
+            with open(os.path.join(project_dir, "Carol.txt"), "w") as f:
+                f.write("Smith_they is here.\n")
+
+            output_dir = os.path.join(project_dir, "output")
+            main(["-a", "--report-file", os.path.join(project_dir, "report.json"), project_dir])
+            # Carol.txt only depends on smith, so it is written once for each of smith's genders
+            self.assertEqual(self.last_out(), "Reused 2 identical output(s), saving 25 bytes\n")
+            male = [os.stat(os.path.join(output_dir, cast, "Carol.txt")) for cast in ("default", "jones-male")]
+            self.assertTrue(os.path.samestat(*male))
+            self.assertEqual(male[0].st_nlink, 2)
+            with open(os.path.join(project_dir, "report.json")) as f:
+                report = json.load(f)
+            self.assertEqual(sorted(report["deduplicated"]), ["default/Carol.txt", "smith-female/Carol.txt"])
+            self.assertEqual(report["saved_bytes"], 25)
+
+            # Linked outputs are replaced, not written through, when they are rendered differently
+            with open(os.path.join(project_dir, "Carol.txt"), "w") as f:
+                f.write("Jones_they is here.\n")
+            main(["-a", project_dir])
+            self.last_out()
+            with open(os.path.join(output_dir, "default", "Carol.txt")) as f:
+                self.assertEqual(f.read(), "She is here.\n")
+            with open(os.path.join(output_dir, "jones-male", "Carol.txt")) as f:
+                self.assertEqual(f.read(), "He is here.\n")
+
+            main(["-a", "-f", "--dedup", "none", project_dir])
+            self.assertEqual(self.last_out(), "")
+            self.assertEqual(os.stat(os.path.join(output_dir, "jones-male", "Carol.txt")).st_nlink, 1)
+        finally:
+            shutil.rmtree(os.path.dirname(project_dir))
+
+    def test_shards(self):
+        output_dir = tempfile.mkdtemp()
+        report_file = os.path.join(output_dir, "report.json")
+        try:
+            main(["--no-cache", "-a", "--shard", "1/3", "-o", output_dir, "test_data/casts"])
+            main(["--no-cache", "-a", "--shard", "2/3", "-o", output_dir, "test_data/casts"])
+            self.assertEqual(sorted(os.listdir(output_dir)), [".genderiser-shards", "default", "jones-male", "smith-female"])
+
+            with self.assertRaises(GenderiserError) as cm:
+                main(["--no-cache", "-a", "--merge-shards", "3", "-o", output_dir, "test_data/casts"])
+            self.assertEqual(str(cm.exception), "Sharded render is incomplete:\nShard 3/3 has not finished\nMissing or out of date output smith-female.jones-male/Alice.txt")
+
+            main(["--no-cache", "-a", "--shard", "3/3", "-o", output_dir, "test_data/casts"])
+            main(["--no-cache", "-a", "--merge-shards", "3", "--report-file", report_file, "-o", output_dir, "test_data/casts"])
+            self.assertEqual(self.last_out(), "")
+            with open(report_file) as f:
+                report = json.load(f)
+            self.assertEqual(sorted(report["written"]), sorted("%s/Alice.txt" % cast for cast in os.listdir(output_dir) if os.path.isdir(os.path.join(output_dir, cast)) and not cast.startswith(".")))
+            self.assertEqual(len(report["counts"]), 4)
+
+            with self.assertRaises(GenderiserError):
+                main(["--no-cache", "--shard", "1/2", "-o", output_dir, "test_data/casts"])
+            with self.assertRaises(GenderiserError):
+                main(["--no-cache", "-a", "--shard", "3/2", "-o", output_dir, "test_data/casts"])
+
+            # Casts are only generated as they are needed, so a render with many characters can still start
+            gen = Genderiser(config={"characters": dict(("c%d" % i, "male") for i in range(40)), "female": {}})
+            casts = gen.casts_from(argparse.Namespace(all_casts=True, cast_genders="male,female", casts=False, casts_file=None))
+            self.assertEqual(next(casts)[1], dict(("c%d" % i, "male") for i in range(40)))
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_zipped_output(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            main(["--no-cache", "-o", output_dir, "example"])
+
+            for filename, contentfile in (("Alice.odt", "content.xml"), ("Alice.docx", "word/document.xml")):
+                with zipfile.ZipFile(os.path.join("example", filename)) as infile, zipfile.ZipFile(os.path.join(output_dir, filename)) as outfile:
+                    self.assertIsNone(outfile.testzip())
+                    # Members keep their order and compression
+                    self.assertEqual([(i.filename, i.compress_type) for i in infile.infolist()], [(i.filename, i.compress_type) for i in outfile.infolist()])
+                    for info in infile.infolist():
+                        if info.filename != contentfile:
+                            self.assertEqual(infile.read(info), outfile.read(info.filename))
+                    content = outfile.read(contentfile).decode("utf-8")
+                    self.assertIn("John", content)
+                    self.assertNotIn("smith_", content)
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_jobs(self):
+        main(["--no-cache", "-p", "example"])
+        sequential = self.last_out()
+        main(["--no-cache", "-j", "2", "-p", "example"])
+        self.assertEqual(self.last_out(), sequential)
+        main(["--no-cache", "-j", "2", "--memory-budget", "0", "-p", "example"])
+        self.assertEqual(self.last_out(), sequential)
+
+    def test_scheduler(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            sizes = {"a.txt": 10, "b.txt": 50, "c.txt": 30, "d.txt": 40, "e.txt": 20}
+            for filename, size in sizes.items():
+                with open(os.path.join(project_dir, filename), "w") as f:
+                    f.write("x" * size)
+            filehelpers = [FileHelper.get_helper(os.path.join(project_dir, filename), project_dir) for filename in sorted(sizes)]
+
+            lock = threading.Lock()
+            started = []
+            in_progress = []
+            peaks = []
+
+            def process_file(filehelper, job):
+                with lock:
+                    started.append(filehelper.filename)
+                    in_progress.append(sizes[filehelper.filename])
+                    peaks.append(sum(in_progress))
+                time.sleep(0.02)
+                with lock:
+                    in_progress.remove(sizes[filehelper.filename])
+                return FileResult(filehelper.filename)
+
+            # Threads stand in for worker processes, so that the files in progress can be watched
+            with mock.patch("concurrent.futures.ProcessPoolExecutor", concurrent.futures.ThreadPoolExecutor), mock.patch("genderiser.process_file", process_file):
+                results = list(Scheduler(3, 60 * TextFileHelper.TEXT_COPIES).run(filehelpers, Job(None, [])))
+
+            # The largest files go first, within the budget, and results come back in the order the files were found
+            self.assertEqual(started, ["b.txt", "d.txt", "c.txt", "e.txt", "a.txt"])
+            self.assertLessEqual(max(peaks), 60)
+            self.assertEqual([result.filename for result in results], sorted(sizes))
+
+            # While the first file is slow, later results are held back and no more files are found than the lookahead allows
+            found = []
+
+            def discover():
+                for filehelper in filehelpers:
+                    found.append(filehelper.filename)
+                    yield filehelper
+
+            def slow_first(filehelper, job):
+                if filehelper.filename == "a.txt":
+                    time.sleep(0.2)
+                return FileResult(filehelper.filename)
+
+            scheduler = Scheduler(1)
+            scheduler.lookahead = 2
+            with mock.patch("concurrent.futures.ProcessPoolExecutor", concurrent.futures.ThreadPoolExecutor), mock.patch("genderiser.process_file", slow_first):
+                results = scheduler.run(discover(), Job(None, []))
+                self.assertEqual(next(results).filename, "a.txt")
+                self.assertEqual(found, ["a.txt", "b.txt"])
+                self.assertEqual([result.filename for result in results], sorted(sizes)[1:])
+        finally:
+            shutil.rmtree(project_dir)
+
+    def test_errors_collected(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(project_dir, "project.cfg"), "w") as f:
+                f.write("[files]\nfiles=Bad.txt, Good.txt\n\n[characters]\nsmith = male\n")
+            with open(os.path.join(project_dir, "Bad.txt"), "wb") as f:
+                f.write(b"An undecodable caf\xe9 for smith_them.")
+            with open(os.path.join(project_dir, "Good.txt"), "w") as f:
+                f.write("A coffee for smith_them.")
+
+            with self.assertRaises(GenderiserError) as cm:
+                main(["-j", "2", project_dir])
+
+            self.assertIn("Bad.txt", str(cm.exception))
+            # The bad file does not stop the good one from being written
+            with open(os.path.join(project_dir, "output", "Good.txt")) as f:
+                self.assertEqual(f.read(), "A coffee for him.")
+        finally:
+            shutil.rmtree(project_dir)
+
+    def test_undetected_file_collected(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(project_dir, "project.cfg"), "w") as f:
+                f.write("[files]\nglob=*.txt\n\n[characters]\nsmith = male\n")
+            with open(os.path.join(project_dir, "Alice.txt"), "w") as f:
+                f.write("A coffee for smith_them.")
+            with open(os.path.join(project_dir, "Zed.txt"), "wb") as f:
+                f.write(bytes(range(256)))
+
+            for jobs in ("1", "2"):
+                with self.assertRaises(GenderiserError) as cm:
+                    main(["-j", jobs, "-f", project_dir])
+                self.assertIn("Unable to process 1 file(s)", str(cm.exception))
+                self.assertIn("Zed.txt", str(cm.exception))
+
+                # The other files are written and recorded in the manifest
+                with open(os.path.join(project_dir, "output", ".genderiser-manifest.json")) as f:
+                    self.assertEqual(list(json.load(f)["files"]), ["Alice.txt"])
+        finally:
+            shutil.rmtree(project_dir)
+
+    def test_incremental(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            project_dir = shutil.copytree("test_data/glob", os.path.join(project_dir, "glob"))
+            main([project_dir])
+            self.assertEqual(self.last_out(), "")
+
+            main([project_dir])
+            self.assertEqual(self.last_out(), "Skipped unchanged file Alice.txt\nSkipped unchanged file Bob.txt\n")
+
+            with open(os.path.join(project_dir, "Bob.txt"), "a") as f:
+                f.write("\nJones_they is here.\n")
+            main([project_dir])
+            self.assertEqual(self.last_out(), "Skipped unchanged file Alice.txt\n")
+            with open(os.path.join(project_dir, "output", "Bob.txt")) as f:
+                self.assertTrue(f.read().endswith("She is here.\n"))
+
+            main(["-f", project_dir])
+            self.assertEqual(self.last_out(), "")
+        finally:
+            shutil.rmtree(os.path.dirname(project_dir))
+
+    def test_changed_character(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            project_dir = shutil.copytree("test_data/glob", os.path.join(project_dir, "glob"))
+            with open(os.path.join(project_dir, "Carol.txt"), "w") as f:
+                f.write("Smith_they is here.\n")
+            main([project_dir])
+            self.last_out()
+
+            # Only the files which mention jones are rendered again
+            with open(os.path.join(project_dir, "glob.cfg")) as f:
+                config = f.read()
+            with open(os.path.join(project_dir, "glob.cfg"), "w") as f:
+                f.write(config.replace("jones = female", "jones = male"))
+            main([project_dir])
+            self.assertEqual(self.last_out(), "Characters changed since the last run: jones\nSkipped unchanged file Carol.txt\n")
+
+            with open(os.path.join(project_dir, "output", "Bob.txt")) as f:
+                self.assertEqual(f.read(), "You know a man called John Smith. He has a brother called Mark Jones.\n")
+        finally:
+            shutil.rmtree(os.path.dirname(project_dir))
+
+    def test_template_cache(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            project_dir = shutil.copytree("test_data/glob", os.path.join(project_dir, "glob"))
+            main(["-p", project_dir])
+            expected_preview = self.last_out()
+
+            # Unchanged files are not read again
+            with mock.patch.object(TextFileHelper, "read", side_effect=AssertionError("File was read")):
+                main(["-p", project_dir])
+                self.assertEqual(self.last_out(), expected_preview)
+                main(["-m", project_dir])
+                self.assertEqual(self.last_out(), "\n")
+
+            with self.assertRaises(GenderiserError):
+                with mock.patch.object(TextFileHelper, "read", side_effect=AssertionError("File was read")):
+                    main(["--no-cache", "-p", project_dir])
+        finally:
+            shutil.rmtree(os.path.dirname(project_dir))
+
+    def test_template_cache_eviction(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            gen = Genderiser("test_data/glob", cache=False)
+            gen.find_files()
+            template = gen.files[0].load_template(gen.VARIABLE_REGEX)
+            cache = TemplateCache(project_dir, len(template.dumps()) + 1)
+
+            for key in ("a", "b", "c"):
+                cache.put(key, template)
+                os.utime(os.path.join(cache.path, key), (0, len(key) + ord(key)))
+            cache.get("a")
+            cache.evict()
+
+            # Only the most recently used template fits
+            self.assertEqual(os.listdir(cache.path), ["a"])
+        finally:
+            shutil.rmtree(project_dir)
+
+    def test_template_cache_unwritable(self):
+        project_file = tempfile.mkstemp()[1]
+        try:
+            gen = Genderiser("test_data/glob", cache=False)
+            gen.find_files()
+            template = gen.files[0].load_template(gen.VARIABLE_REGEX)
+
+            # The cache directory can't be created inside a file, so templates are only kept in memory
+            cache = TemplateCache(project_file, 1024 * 1024)
+            cache.put("a", template)
+            self.assertEqual(cache.get("a").dumps(), template.dumps())
+        finally:
+            os.remove(project_file)
+
+    def test_cased_variants(self):
+        gen = Genderiser("example", cache=False)
+        template = Template.from_text(gen.VARIABLE_REGEX, "smith_they, Smith_they, SMITH_THEY, smith_nonsense")
+        self.assertEqual(template.render(SubstitutionTable(gen.subs)), "he, He, HE, UNKNOWN")
+
+    def test_gender_inheritance_cycle(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(project_dir, "project.cfg"), "w") as f:
+                f.write("[genders]\nfirst = second\nsecond = first\n\n[first]\n\n[second]\n\n[characters]\nsmith = first\n")
+
+            with self.assertRaises(GenderiserError) as cm:
+                Genderiser(project_dir)
+            self.assertIn("first -> second -> first", str(cm.exception))
+        finally:
+            shutil.rmtree(project_dir)
+
+    def test_table(self):
+        gen = Genderiser("test_data/spivak", cache=False)
+        # Genders are resolved once and shared between characters
+        self.assertIs(gen.resolve_gender("spivak"), gen.resolve_gender("spivak"))
+        self.assertEqual(gen.resolve_gender("spivak")["person"], "person")
+        self.assertEqual(gen.table.lookup("Kim", "them"), "Em")
+        self.assertEqual(gen.create_table({"smith": "female"}).lookup("smith", "name"), "Jane")
+
+    def test_stream_sub(self):
+        gen = Genderiser("example", cache=False)
+        text = "You know a smith_person called smith_name Smith. Smith_they has a jones_sibling called jones_name Jones. " * 5
+        repl = lambda m: gen.table.lookup(*m.groups())
+        expected = gen.VARIABLE_REGEX.sub(repl, text)
+
+        # Variables which straddle chunk boundaries are still substituted
+        for size in (1, 3, 7, 50):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            self.assertEqual("".join(stream_sub(gen.VARIABLE_REGEX, chunks, repl, margin=20)), expected)
+
+    def test_stream_text_mode(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            main(["--no-cache", "-o", os.path.join(output_dir, "memory"), "test_data/spivak"])
+            main(["--no-cache", "--text-mode", "stream", "-o", os.path.join(output_dir, "stream"), "test_data/spivak"])
+            main(["--no-cache", "--text-mode", "mmap", "-o", os.path.join(output_dir, "mmap"), "test_data/spivak"])
+
+            with open(os.path.join(output_dir, "memory", "Alice.txt")) as memory, open(os.path.join(output_dir, "stream", "Alice.txt")) as stream:
+                self.assertEqual(memory.read(), stream.read())
+            with open(os.path.join(output_dir, "memory", "Alice.txt")) as memory, open(os.path.join(output_dir, "mmap", "Alice.txt")) as mapped:
+                self.assertEqual(memory.read(), mapped.read())
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_split_runs(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            with open("example/example.cfg") as f:
+                config = f.read().replace("files=Alice.txt,Alice.odt,Alice.docx", "files=Split.docx")
+            with open(os.path.join(project_dir, "example.cfg"), "w") as f:
+                f.write(config)
+
+            # Variables split across runs are found, but not across paragraphs
+            document = '<w:document><w:body><w:p><w:r><w:t>smith_</w:t></w:r><w:r><w:rPr><w:b/></w:rPr><w:t>name Jones_</w:t></w:r></w:p><w:p><w:r><w:t>they</w:t></w:r></w:p></w:body></w:document>'
+            expected = '<w:document><w:body><w:p><w:r><w:t>John</w:t></w:r><w:r><w:rPr><w:b/></w:rPr><w:t> Jones_</w:t></w:r></w:p><w:p><w:r><w:t>they</w:t></w:r></w:p></w:body></w:document>'
+            header = '<w:hdr><w:p><w:r><w:t>jones_name</w:t></w:r></w:p></w:hdr>'
+
+            with zipfile.ZipFile("example/Alice.docx") as zipped_infile, zipfile.ZipFile(os.path.join(project_dir, "Split.docx"), "w") as zipped_outfile:
+                for fileinfo in zipped_infile.infolist():
+                    data = document if fileinfo.filename == "word/document.xml" else zipped_infile.read(fileinfo)
+                    zipped_outfile.writestr(fileinfo, data)
+                zipped_outfile.writestr("word/header1.xml", header)
+
+            for text_mode in ("memory", "stream"):
+                output_dir = os.path.join(project_dir, text_mode)
+                main(["--no-cache", "--text-mode", text_mode, "-o", output_dir, project_dir])
+                with zipfile.ZipFile(os.path.join(output_dir, "Split.docx")) as z:
+                    self.assertEqual(z.read("word/document.xml").decode("utf-8"), expected)
+                    # Other parts, such as headers, are substituted in the same pass
+                    self.assertEqual(z.read("word/header1.xml").decode("utf-8"), header.replace("jones_name", "Mary"))
+
+            self.last_out()
+            main(["--no-cache", "-w", "jones", project_dir])
+            self.assertEqual(self.last_out(), "Split.docx:word/header1.xml:1:22: jones_name\n")
+        finally:
+            shutil.rmtree(project_dir)
+
+    def test_tracked_changes(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            with open("example/example.cfg") as f:
+                config = f.read().replace("files=Alice.txt,Alice.odt,Alice.docx", "files=Tracked.docx")
+            with open(os.path.join(project_dir, "example.cfg"), "w") as f:
+                f.write(config)
+
+            # Deleted text and field instructions are not part of the text, but are kept in the output
+            document = '<w:document><w:body><w:p><w:r><w:t>smith_th</w:t></w:r><w:del><w:r><w:delText>ye</w:delText></w:r></w:del><w:ins><w:r><w:t>ey </w:t></w:r></w:ins><w:r><w:instrText xml:space="preserve"> jones_name </w:instrText></w:r><w:r><w:t>jones_</w:t></w:r><w:r><w:delText/></w:r><w:r><w:t>name</w:t></w:r></w:p></w:body></w:document>'
+            expected = '<w:document><w:body><w:p><w:r><w:t>he</w:t></w:r><w:del><w:r><w:delText>ye</w:delText></w:r></w:del><w:ins><w:r><w:t> </w:t></w:r></w:ins><w:r><w:instrText xml:space="preserve"> jones_name </w:instrText></w:r><w:r><w:t>Mary</w:t></w:r><w:r><w:delText/></w:r><w:r><w:t></w:t></w:r></w:p></w:body></w:document>'
+
+            with zipfile.ZipFile("example/Alice.docx") as zipped_infile, zipfile.ZipFile(os.path.join(project_dir, "Tracked.docx"), "w") as zipped_outfile:
+                for fileinfo in zipped_infile.infolist():
+                    data = document if fileinfo.filename == "word/document.xml" else zipped_infile.read(fileinfo)
+                    zipped_outfile.writestr(fileinfo, data)
+
+            for text_mode in ("memory", "stream"):
+                output_dir = os.path.join(project_dir, text_mode)
+                main(["--no-cache", "--text-mode", text_mode, "-o", output_dir, project_dir])
+                with zipfile.ZipFile(os.path.join(output_dir, "Tracked.docx")) as z:
+                    self.assertEqual(z.read("word/document.xml").decode("utf-8"), expected)
+
+            # Hidden elements which arrive in several chunks are held back until they end
+            regex = Genderiser(project_dir, cache=False).VARIABLE_REGEX
+            with open(os.path.join(project_dir, "Tracked.docx"), "rb") as f:
+                filehelper = FileHelper.from_file(f)
+                chunks = [document[i:i + 7] for i in range(0, len(document), 7)]
+                tokens = list(xml_tokens(regex, chunks, filehelper.BREAK_TAG, margin=16, hidden=filehelper.HIDDEN_TAG))
+            self.assertEqual([token[0].group(0) for token in tokens if not isinstance(token, str)], ["smith_they", "jones_name"])
+        finally:
+            shutil.rmtree(project_dir)
+
+    def test_render_in_memory(self):
+        with open("example/example.cfg") as f:
+            gen = Genderiser(config=f.read())
+
+        with open("example/Alice.txt", "rb") as f:
+            document = f.read()
+        self.assertEqual(gen.render(document), b"You know a man called John Smith. He has a sister called Mary Jones.\n")
+        self.assertEqual(gen.render(document, {"smith": "female"}), b"You know a woman called Jane Smith. She has a sister called Mary Jones.\n")
+
+        # Config can also be given as a dict, and zipped documents as file objects
+        gen = Genderiser(config={"characters": {"smith": "female", "jones": "male"}, "male": {"jones_name": "Mark"}, "female": {"smith_name": "Jane"}})
+        with open("example/Alice.docx", "rb") as f:
+            rendered = gen.render(f)
+        with zipfile.ZipFile(io.BytesIO(rendered)) as z:
+            self.assertIn("Jane", z.read("word/document.xml").decode("utf-8"))
+
+    def test_serve(self):
+        project_dir = shutil.copytree("example", os.path.join(tempfile.mkdtemp(), "example"))
+        server = RenderServer(("127.0.0.1", 0), RenderService(project_dir))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = "http://127.0.0.1:%d/" % server.server_address[1]
+
+            with urllib.request.urlopen(url + "missing") as response:
+                self.assertEqual(response.read(), b"\n")
+            with urllib.request.urlopen(url + "preview") as response:
+                self.assertIn(b"You know a man called John Smith.", response.read())
+
+            # Changes to the config are picked up by the next request
+            with open(os.path.join(project_dir, "example.cfg"), "a") as f:
+                f.write("\n[casts]\nswapped = smith:female, jones:male\n")
+            with urllib.request.urlopen(url + "preview?cast=swapped") as response:
+                self.assertIn(b"You know a woman called Jane Smith.", response.read())
+
+            with open(os.path.join(project_dir, "Alice.txt"), "rb") as f:
+                request = urllib.request.Request(url + "document?cast=swapped", data=f.read())
+            with urllib.request.urlopen(request) as response:
+                self.assertEqual(response.read(), b"You know a woman called Jane Smith. She has a brother called Mark Jones.\n")
+
+            with urllib.request.urlopen(urllib.request.Request(url + "render", data=b"")) as response:
+                report = json.loads(response.read().decode("utf-8"))
+            self.assertEqual(sorted(report["written"]), ["Alice.docx", "Alice.odt", "Alice.txt"])
+
+            # Only projects inside the server's project directory can be used
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                urllib.request.urlopen(url + "missing?project=..")
+            self.assertEqual(cm.exception.code, 400)
+
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                urllib.request.urlopen(url + "preview?cast=nobody")
+            self.assertEqual(cm.exception.code, 400)
+
+            with urllib.request.urlopen(url + "metrics") as response:
+                metrics = json.loads(response.read().decode("utf-8"))
+            self.assertEqual(metrics["preview"]["count"], 3)
+            self.assertEqual(metrics["preview"]["errors"], 1)
+
+            # The server has no authentication, so it is only served on loopback addresses
+            with self.assertRaises(GenderiserError):
+                serve("0.0.0.0:0", Genderiser(project_dir))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            shutil.rmtree(os.path.dirname(project_dir))
+
+    def test_watch(self):
+        project_dir = shutil.copytree("test_data/glob", os.path.join(tempfile.mkdtemp(), "glob"))
+        try:
+            output_dir = os.path.join(project_dir, "output")
+            with open(os.path.join(project_dir, "Carol.txt"), "w") as f:
+                f.write("jones_name\n")
+
+            args = argparse.Namespace(project_dir=project_dir, output_dir=output_dir, casts_file=None, casts=False, all_casts=False, cast_genders=None, jobs=1, force=False, text_mode="memory", dedup="link", memory_budget=None, no_cache=False, stats=False)
+            watcher = Watcher(Genderiser(project_dir), args)
+            watcher.INTERVAL = watcher.DEBOUNCE = 0.01
+            watcher.gen.replace(output_dir)
+
+            # Only changed documents are rendered again
+            with open(os.path.join(project_dir, "Bob.txt"), "a") as f:
+                f.write("smith_they\n")
+            report = watcher.update(watcher.changes())
+            self.assertEqual(report.written, ["Bob.txt"])
+            with open(os.path.join(output_dir, "Bob.txt")) as f:
+                self.assertTrue(f.read().endswith("he\n"))
+
+            # A config change renders only the documents which use substitutions which changed
+            with open(os.path.join(project_dir, "glob.cfg")) as f:
+                config = f.read()
+            with open(os.path.join(project_dir, "glob.cfg"), "w") as f:
+                f.write(config.replace("smith_name = John", "smith_name = Johnny"))
+            report = watcher.update(watcher.changes())
+            self.assertEqual(report.written, ["Alice.txt", "Bob.txt"])
+            with open(os.path.join(output_dir, "Alice.txt")) as f:
+                self.assertIn("Johnny", f.read())
+
+            # A deleted document is not a config change; its output and manifest entry are removed
+            gen = watcher.gen
+            os.remove(os.path.join(project_dir, "Carol.txt"))
+            report = watcher.update(watcher.changes())
+            self.assertIs(watcher.gen, gen)
+            self.assertEqual((report.written, report.removed), ([], ["Carol.txt"]))
+            self.assertFalse(os.path.exists(os.path.join(output_dir, "Carol.txt")))
+            with open(os.path.join(output_dir, ".genderiser-manifest.json")) as f:
+                self.assertEqual(sorted(json.load(f)["files"]), ["Alice.txt", "Bob.txt"])
+
+            # A new variable regex renders every document again
+            with open(os.path.join(project_dir, "glob.cfg"), "a") as f:
+                f.write("\n[main]\nvariable_regex = \\$([A-Za-z]+)_([A-Za-z]+)\n")
+            report = watcher.update(watcher.changes())
+            self.assertEqual(sorted(report.written), ["Alice.txt", "Bob.txt"])
+            with open(os.path.join(project_dir, "Alice.txt")) as f, open(os.path.join(output_dir, "Alice.txt")) as g:
+                self.assertEqual(f.read(), g.read())
+        finally:
+            shutil.rmtree(os.path.dirname(project_dir))
+
+    def test_watch_new_cast(self):
+        project_dir = shutil.copytree("test_data/casts", os.path.join(tempfile.mkdtemp(), "casts"))
+        try:
+            output_dir = os.path.join(project_dir, "output")
+            with open(os.path.join(project_dir, "Plain.txt"), "w") as f:
+                f.write("No variables here.\n")
+            with open(os.path.join(project_dir, "casts.cfg")) as f:
+                config = f.read().replace("files=Alice.txt", "files=Alice.txt, Plain.txt")
+            with open(os.path.join(project_dir, "casts.cfg"), "w") as f:
+                f.write(config)
+
+            args = argparse.Namespace(project_dir=project_dir, output_dir=output_dir, casts_file=None, casts=True, all_casts=False, cast_genders=None, jobs=1, force=False, text_mode="memory", dedup="link", memory_budget=None, no_cache=False, stats=False)
+            watcher = Watcher(Genderiser(project_dir), args)
+            watcher.INTERVAL = watcher.DEBOUNCE = 0.01
+            watcher.gen.replace(output_dir, casts=watcher.gen.casts_from(args))
+
+            # A new cast gets every document, including those without variables
+            with open(os.path.join(project_dir, "casts.cfg"), "w") as f:
+                f.write(config.replace("swapped = smith:female, jones:male", "swapped = smith:female, jones:male\nbothmale = jones:male"))
+            report = watcher.update(watcher.changes())
+            self.assertEqual(sorted(report.written), ["bothmale/Alice.txt", "bothmale/Plain.txt"])
+            with open(os.path.join(output_dir, "bothmale", ".genderiser-manifest.json")) as f:
+                self.assertEqual(sorted(json.load(f)["files"]), ["Alice.txt", "Plain.txt"])
+        finally:
+            shutil.rmtree(os.path.dirname(project_dir))
+
+    def test_startup_imports(self):
+        # Modules only needed by some commands are not imported by a short run, which is checked in a new interpreter
+        code = "import sys, genderiser\ngenderiser.main(['--no-cache', '-s', 'test_data/glob'])\nprint(','.join(m for m in ('zipfile', 'hashlib', 'concurrent.futures', 'http.server') if m in sys.modules), file=sys.stderr)"
+        result = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        self.assertIn("smith_name", result.stdout)
+        self.assertEqual(result.stderr, "\n")
+
+    def test_single_open(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch("builtins.open", wraps=open) as mock_open:
+                main(["--no-cache", "-o", output_dir, "example"])
+
+            # Each input file is opened once, to detect its type, checksum, read and copy it
+            opened = [call[0][0] for call in mock_open.call_args_list]
+            for filename in ("Alice.txt", "Alice.odt", "Alice.docx"):
+                self.assertEqual(opened.count(os.path.join("example", filename)), 1)
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_stats(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            stats_file = os.path.join(output_dir, "stats.json")
+            main(["--no-cache", "--stats", "--stats-format", "json", "--stats-file", stats_file, "-o", os.path.join(output_dir, "output"), "example"])
+
+            with open(stats_file) as f:
+                stats = json.load(f)
+
+            stages = dict((total["stage"], total) for total in stats["stages"])
+            self.assertEqual(set(stages), set(["config", "find_files", "checksum", "read", "scan", "substitute", "write"]))
+            self.assertEqual(stages["write"]["count"], 3)
+            self.assertEqual(stages["scan"]["matches"], 15)
+            self.assertEqual(stages["read"]["bytes"], sum(os.path.getsize(os.path.join("example", f)) for f in ("Alice.txt", "Alice.odt", "Alice.docx")))
+
+            # --stats takes no value, so the project directory can follow it
+            main(["--no-cache", "-f", "--stats-file", stats_file, "-o", os.path.join(output_dir, "output"), "--stats", "example"])
+            with open(stats_file) as f:
+                self.assertTrue(f.read().startswith("Stage"))
+        finally:
+            shutil.rmtree(output_dir)
+
+        # The peak memory of a stage includes that of the stages nested in it
+        stats = Stats()
+        with stats.stage("outer"):
+            with stats.stage("inner"):
+                data = bytearray(1000000)
+                del data
+            with stats.stage("after"):
+                pass
+        peaks = dict((record["stage"], record["peak_memory"]) for record in stats.records)
+        self.assertGreaterEqual(peaks["inner"], 1000000)
+        self.assertGreaterEqual(peaks["outer"], peaks["inner"])
+        self.assertLess(peaks["after"], 1000000)
+
+    def test_where(self):
+        main(["--no-cache", "-w", "Smith_they", "test_data/missingsubs"])
+        self.assertEqual(self.last_out(), "Alice.txt:1:49: Smith_they\n")
+
+        main(["--no-cache", "-w", "jones", "test_data/subdir"])
+        self.assertEqual(self.last_out(), "One/Alice.txt:1:66: jones_sibling\nOne/Alice.txt:1:87: jones_name\nTwo/Bob.txt:1:66: jones_sibling\nTwo/Bob.txt:1:87: jones_name\n")
+
+    def test_variable_index(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            project_dir = shutil.copytree("test_data/glob", os.path.join(project_dir, "glob"))
+            main(["-m", project_dir])
+            self.assertEqual(self.last_out(), "\n")
+
+            # Files which have not changed are not scanned again
+            with mock.patch.object(Template, "from_text", side_effect=AssertionError("File was scanned")):
+                main(["-m", project_dir])
+                self.assertEqual(self.last_out(), "\n")
+
+            # A file indexed just after it changed is scanned again, even if a later change keeps its size and modification time
+            path = os.path.join(project_dir, "Bob.txt")
+            os.utime(path)
+            main(["-m", project_dir])
+            self.last_out()
+            st = os.stat(path)
+            with open(path) as f:
+                text = f.read()
+            with open(path, "w") as f:
+                f.write(text.replace("jones_name", "jones_nick"))
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            main(["-m", project_dir])
+            self.assertEqual(self.last_out(), "jones_nick\n")
+            with open(path, "w") as f:
+                f.write(text)
+
+            with open(os.path.join(project_dir, "Alice.txt"), "a") as f:
+                f.write("\nsmith_nickname\n")
+            main(["-m", project_dir])
+            self.assertEqual(self.last_out(), "smith_nickname\n")
+            main(["-w", "smith_nickname", project_dir])
+            self.assertEqual(self.last_out(), "Alice.txt:3:%d: smith_nickname\n" % (os.path.getsize(os.path.join(project_dir, "Alice.txt")) - 15))
+        finally:
+            shutil.rmtree(os.path.dirname(project_dir))
+
+    def test_unwritable_cache(self):
+        project_dir = tempfile.mkdtemp()
+        try:
+            project_dir = shutil.copytree("test_data/glob", os.path.join(project_dir, "glob"))
+            # Nothing can be written inside the cache directory if it is a file
+            shutil.rmtree(os.path.join(project_dir, TemplateCache.DIRNAME), ignore_errors=True)
+            with open(os.path.join(project_dir, TemplateCache.DIRNAME), "w") as f:
+                f.write("")
+            # Find the documents by walking the project, which also caches its listings
+            with open(os.path.join(project_dir, "glob.cfg")) as f:
+                config = f.read().replace("glob=*.txt", "include=*.txt")
+            with open(os.path.join(project_dir, "glob.cfg"), "w") as f:
+                f.write(config)
+            os.utime(project_dir, (time.time() - 60, time.time() - 60))
+
+            main(["-w", "jones_name", project_dir])
+            self.assertEqual(self.last_out(), "Alice.txt:1:87: jones_name\nBob.txt:1:87: jones_name\n")
+            main([project_dir])
+            with open(os.path.join(project_dir, "output", "Bob.txt")) as f:
+                self.assertIn("Mary Jones", f.read())
+        finally:
+            shutil.rmtree(os.path.dirname(project_dir))
+
+    def test_usage_report(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            report_file = os.path.join(output_dir, "report.json")
+            expected_unknown = [
+                {"file": "Alice.txt", "part": None, "offset": 11, "line": 1, "variable": "smith_person"},
+                {"file": "Alice.txt", "part": None, "offset": 31, "line": 1, "variable": "smith_name"},
+                {"file": "Alice.txt", "part": None, "offset": 49, "line": 1, "variable": "Smith_they"},
+                {"file": "Alice.txt", "part": None, "offset": 87, "line": 1, "variable": "jones_name"},
+            ]
+
+            # Unknown variables are found in the same pass as rendering, whether the file is streamed, rendered or skipped
+            for options in (["--text-mode", "memory"], ["--text-mode", "stream", "--force"], []):
+                with mock.patch("sys.stderr", new_callable=io.StringIO):
+                    with self.assertRaises(GenderiserError):
+                        main(["--no-cache", "--strict", "--report-file", report_file, "-o", os.path.join(output_dir, "output"), "test_data/missingsubs"] + options)
+
+                with open(report_file) as f:
+                    report = json.load(f)
+                self.assertEqual(report["unknown"], expected_unknown)
+                self.assertEqual(report["counts"], [{"cast": None, "characters": {"jones": 1}}])
+
+            self.assertEqual(report["skipped"], ["Alice.txt"])
+        finally:
+            shutil.rmtree(output_dir)
+
 if __name__ == "__main__":
     unittest.main()